@@ -8,72 +8,161 @@ Includes WhisperFlow audio transcription
 """
 
 import os
+import io
 import hmac
 import hashlib
+import http.cookiejar
 import json
+import logging
+import atexit
+import mimetypes
 import subprocess
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import threading
+import queue
 import tempfile
+import time
 import re
+import traceback
 import urllib.parse
 import sqlite3
+import xml.etree.ElementTree as ET
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import islice
+from string import Template
+from xml.sax.saxutils import escape
 from datetime import datetime
 from flask import Flask, request, jsonify
 
+# Fast JSON (orjson) when available, standard library otherwise
+try:
+    import orjson
+
+    _loads = orjson.loads
+
+    def _dumps(obj):
+        """Serialize obj to a JSON str"""
+        return orjson.dumps(obj).decode()
+
+    _dumps_bytes = orjson.dumps
+except ImportError:
+    _loads = json.loads
+    _dumps = json.dumps
+
+    def _dumps_bytes(obj):
+        """Serialize obj to UTF-8 encoded JSON bytes"""
+        return json.dumps(obj).encode()
+
 # Task Bot Database
 TASK_DB_PATH = '/opt/deck-bot-poc/data/deck_bot.db'
 
+# Applied to every SQLite connection we open
+SQLITE_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA cache_size=-8000',
+)
+
+# Hot-path queries, kept as constants so the connection's statement cache reuses them
+_SQL_GET_BOT = 'SELECT * FROM task_bots WHERE conversation_token = ? LIMIT 1'
+_SQL_COMPLETE_BOT = 'UPDATE task_bots SET status = ?, completed_at = datetime("now") WHERE conversation_token = ?'
+
+# One persistent connection per worker thread
+_task_db_local = threading.local()
+_task_db_indexed = False
+_task_db_index_lock = threading.Lock()
+
+
+def _ensure_task_db_index(conn):
+    """Index task_bots on conversation_token (once per process) so lookups don't scan the table"""
+    global _task_db_indexed
+    with _task_db_index_lock:
+        if _task_db_indexed:
+            return
+        # The table belongs to deck-bot-poc: only add a plain index, never a constraint on its rows
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_task_bots_token_nonunique ON task_bots(conversation_token)')
+        _task_db_indexed = True
+
+
+def _get_conn():
+    """Get this thread's connection to the deck-bot-poc database (None if the DB doesn't exist)"""
+    conn = getattr(_task_db_local, 'conn', None)
+    if conn is None:
+        if not os.path.exists(TASK_DB_PATH):
+            return None
+        conn = sqlite3.connect(TASK_DB_PATH, check_same_thread=False, isolation_level=None,
+                               cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        try:
+            _ensure_task_db_index(conn)
+        except sqlite3.Error as e:
+            print(f"Warning: could not index task_bots: {e}")
+        _task_db_local.conn = conn
+    return conn
+
+
 def get_task_bot_by_token(conversation_token):
     """Get task bot info from deck-bot-poc database"""
     try:
-        if not os.path.exists(TASK_DB_PATH):
+        conn = _get_conn()
+        if conn is None:
             return None
-        conn = sqlite3.connect(TASK_DB_PATH)
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute('SELECT * FROM task_bots WHERE conversation_token = ?', (conversation_token,))
-        row = cursor.fetchone()
-        conn.close()
+        row = conn.execute(_SQL_GET_BOT, (conversation_token,)).fetchone()
         return dict(row) if row else None
     except Exception as e:
         print(f"Error getting task bot: {e}")
         return None
 
 
-def detect_completion_intent(message):
+# Explicit completion phrases - complete immediately
+COMPLETION_EXPLICIT_PHRASES = [
+    'taak afronden', 'taak afsluiten', 'taak voltooien',
+    'sluit de taak', 'rond de taak af', 'voltooi de taak',
+    'markeer als klaar', 'markeer als voltooid', 'markeer als afgerond',
+    'zet op klaar', 'zet op done', 'naar klaar verplaatsen',
+    'taak is klaar', 'taak is af', 'taak voltooid',
+    'dit is klaar', 'alles is klaar', 'alles afgerond',
+    'we zijn klaar', 'ik ben klaar', 'klaar met de taak'
+]
+
+# Confirmation phrases - ask for confirmation first
+COMPLETION_CONFIRM_PHRASES = [
+    'kunnen we afronden', 'kunnen we afsluiten',
+    'mag de taak dicht', 'taak dicht', 'afronden?',
+    'is de taak klaar', 'ben je klaar', 'zijn we klaar',
+    'kan dit dicht', 'sluiten we af'
+]
+
+# Each phrase list fused into one alternation so a message is scanned once per list
+_EXPLICIT_RE = re.compile('|'.join(map(re.escape, COMPLETION_EXPLICIT_PHRASES)))
+_CONFIRM_RE = re.compile('|'.join(map(re.escape, COMPLETION_CONFIRM_PHRASES)))
+
+# Longer messages are treated as normal questions, even if they contain a completion phrase
+COMPLETION_INTENT_MAX_LENGTH = 200
+
+
+def detect_completion_intent(message_lower):
     """
     Detect if user wants to complete/close the task via natural language
+    Expects the message already stripped and lowercased
     Returns: 'confirm' if needs confirmation, 'complete' if explicit, None if no intent
     """
-    message_lower = message.lower().strip()
-
-    # Explicit completion phrases - complete immediately
-    explicit_phrases = [
-        'taak afronden', 'taak afsluiten', 'taak voltooien',
-        'sluit de taak', 'rond de taak af', 'voltooi de taak',
-        'markeer als klaar', 'markeer als voltooid', 'markeer als afgerond',
-        'zet op klaar', 'zet op done', 'naar klaar verplaatsen',
-        'taak is klaar', 'taak is af', 'taak voltooid',
-        'dit is klaar', 'alles is klaar', 'alles afgerond',
-        'we zijn klaar', 'ik ben klaar', 'klaar met de taak'
-    ]
-
-    for phrase in explicit_phrases:
-        if phrase in message_lower:
-            return 'complete'
-
-    # Confirmation phrases - ask for confirmation first
-    confirm_phrases = [
-        'kunnen we afronden', 'kunnen we afsluiten',
-        'mag de taak dicht', 'taak dicht', 'afronden?',
-        'is de taak klaar', 'ben je klaar', 'zijn we klaar',
-        'kan dit dicht', 'sluiten we af'
-    ]
-
-    for phrase in confirm_phrases:
-        if phrase in message_lower:
-            return 'confirm'
+    if len(message_lower) >= COMPLETION_INTENT_MAX_LENGTH:
+        return None
+
+    if _EXPLICIT_RE.search(message_lower):
+        return 'complete'
+
+    if _CONFIRM_RE.search(message_lower):
+        return 'confirm'
 
     return None
 
@@ -81,16 +170,16 @@ def detect_completion_intent(message):
 def complete_task(token, bot_config, task_bot):
     """Complete a task - mark in DB and move card to Klaar"""
     try:
-        conn = sqlite3.connect(TASK_DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('UPDATE task_bots SET status = ?, completed_at = datetime("now") WHERE conversation_token = ?',
-                      ('completed', token))
-        conn.commit()
-        conn.close()
+        conn = _get_conn()
+        if conn is None:
+            print(f"Task database not found at {TASK_DB_PATH}")
+            return False
 
-        # Move card to "Klaar" stack in Deck
-        move_card_to_done(task_bot['board_id'], task_bot['stack_id'], task_bot['card_id'])
+        conn.execute(_SQL_COMPLETE_BOT, ('completed', token))
 
+        # Move card to "Klaar" stack in Deck, only once the task is marked completed
+        if not move_card_to_done(task_bot['board_id'], task_bot['stack_id'], task_bot['card_id']):
+            print(f"Task {token} completed, but its Deck card {task_bot['card_id']} could not be moved to Klaar")
         return True
     except Exception as e:
         print(f"Error completing task: {e}")
@@ -110,8 +199,8 @@ def close_conversation(token, nc_user, nc_password):
         auth = (nc_user, nc_password)
 
         # Delete the conversation (this removes it for everyone)
-        url = f"{NEXTCLOUD_URL}/ocs/v2.php/apps/spreed/api/v4/room/{token}"
-        resp = requests.delete(url, auth=auth, headers=headers, timeout=30)
+        url = f"{TALK_ROOM_API}/{token}"
+        resp = SESSION.delete(url, auth=auth, headers=headers, timeout=30)
 
         print(f"Close conversation response: {resp.status_code}")
         return resp.status_code in [200, 204]
@@ -120,49 +209,91 @@ def close_conversation(token, nc_user, nc_password):
         return False
 
 
+def close_conversation_later(token, bot_config, delay=3):
+    """Close the conversation after delay seconds on the worker pool, so the caller doesn't wait"""
+    def close():
+        time.sleep(delay)
+        close_conversation(token, bot_config['nextcloud_user'], bot_config['nextcloud_password'])
+
+    EXECUTOR.submit(close)
+
+
+# Deck "Klaar" stack per board - stack layouts rarely change
+DONE_STACK_CACHE_TTL = 600  # seconds
+_DONE_STACK_RE = re.compile(r'klaar|done|afgerond', re.IGNORECASE)
+_done_stack_cache = {}  # board_id -> (stack_id, fetched_at)
+_done_stack_lock = threading.Lock()
+
+
+def _deck_admin_auth():
+    """Nextcloud credentials used for moving task cards"""
+    return (BOTS['maarten']['nextcloud_user'], BOTS['maarten']['nextcloud_password'])
+
+
+def _get_done_stack_id(board_id):
+    """Get the id of the 'Klaar'/'Done' stack of a board, cached for DONE_STACK_CACHE_TTL seconds"""
+    now = time.monotonic()
+    with _done_stack_lock:
+        cached = _done_stack_cache.get(board_id)
+        if cached and now - cached[1] < DONE_STACK_CACHE_TTL:
+            return cached[0]
+
+    headers = {'OCS-APIRequest': 'true', 'Content-Type': 'application/json'}
+    resp = SESSION.get(
+        f"{DECK_API}/boards/{board_id}/stacks",
+        auth=_deck_admin_auth(), headers=headers, timeout=30
+    )
+
+    if resp.status_code != 200:
+        print(f"Failed to get stacks: {resp.status_code}")
+        return None
+
+    for stack in resp.json():
+        if _DONE_STACK_RE.search(stack.get('title', '')):
+            with _done_stack_lock:
+                _done_stack_cache[board_id] = (stack['id'], now)
+            return stack['id']
+
+    return None
+
+
 def move_card_to_done(board_id, current_stack_id, card_id):
     """Move a Deck card to the 'Klaar' stack"""
     try:
-        # First, find the "Klaar" or "Done" stack
         headers = {'OCS-APIRequest': 'true', 'Content-Type': 'application/json'}
-        auth = (BOTS['maarten']['nextcloud_user'], BOTS['maarten']['nextcloud_password'])
-
-        # Get all stacks
-        resp = requests.get(
-            f"{NEXTCLOUD_URL}/index.php/apps/deck/api/v1.0/boards/{board_id}/stacks",
-            auth=auth, headers=headers, timeout=30
-        )
-
-        if resp.status_code != 200:
-            print(f"Failed to get stacks: {resp.status_code}")
-            return False
-
-        stacks = resp.json()
-        done_stack = None
-        for stack in stacks:
-            title = stack.get('title', '').lower()
-            if 'klaar' in title or 'done' in title or 'afgerond' in title:
-                done_stack = stack
-                break
+        auth = _deck_admin_auth()
 
-        if not done_stack:
+        # First, find the "Klaar" or "Done" stack
+        done_stack_id = _get_done_stack_id(board_id)
+        if done_stack_id is None:
             print("No 'Klaar' stack found")
             return False
 
         # Move card to done stack using reorder
-        move_url = f"{NEXTCLOUD_URL}/index.php/apps/deck/api/v1.0/boards/{board_id}/stacks/{current_stack_id}/cards/{card_id}/reorder"
-        move_data = {'stackId': done_stack['id'], 'order': 0}
+        move_url = f"{DECK_API}/boards/{board_id}/stacks/{current_stack_id}/cards/{card_id}/reorder"
+        move_data = {'stackId': done_stack_id, 'order': 0}
 
-        move_resp = requests.put(move_url, auth=auth, headers=headers, json=move_data, timeout=30)
+        move_resp = SESSION.put(move_url, auth=auth, headers=headers, json=move_data, timeout=30)
         print(f"Move card response: {move_resp.status_code}")
 
-        return move_resp.status_code == 200
+        if move_resp.status_code != 200:
+            # The cached stack may have been removed - look it up again next time
+            with _done_stack_lock:
+                _done_stack_cache.pop(board_id, None)
+            return False
+
+        return True
     except Exception as e:
         print(f"Error moving card: {e}")
         return False
 
 app = Flask(__name__)
 
+# Debug output goes through logging, so it is only formatted when LOG_LEVEL=DEBUG
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'WARNING').upper()
+logging.basicConfig(level=getattr(logging, LOG_LEVEL, logging.WARNING), format='%(levelname)s %(message)s')
+log = logging.getLogger('nextcloud-claude-bot')
+
 # ERPNext base URL (from environment or config)
 ERPNEXT_URL = os.environ.get('ERPNEXT_URL', 'https://your-erpnext.example.com')
 
@@ -173,8 +304,13 @@ def load_bots_config():
     """Load bot configurations from JSON file"""
     if os.path.exists(BOTS_CONFIG_FILE):
         try:
-            with open(BOTS_CONFIG_FILE, 'r') as f:
-                return json.load(f)
+            with open(BOTS_CONFIG_FILE, 'rb') as f:
+                bots = _loads(f.read())
+            # Key the HMAC once per bot; signing and verifying copy this template
+            for bot_config in bots.values():
+                secret = bot_config.get('secret', '')
+                bot_config['_hmac_template'] = hmac.new(secret.encode('utf-8'), digestmod=hashlib.sha256) if secret else None
+            return bots
         except Exception as e:
             print(f"Error loading bots config: {e}")
 
@@ -186,12 +322,26 @@ def load_bots_config():
 BOTS = load_bots_config()
 
 NEXTCLOUD_URL = os.environ.get('NEXTCLOUD_URL', 'https://your-nextcloud.example.com')
+
+# Fixed Nextcloud endpoints
+DAV_ROOT = f"{NEXTCLOUD_URL}/remote.php/dav/"
+DAV_FILES = f"{DAV_ROOT}files/"  # + user + path
+DECK_API = f"{NEXTCLOUD_URL}/index.php/apps/deck/api/v1.0"
+DECK_OCS_API = f"{NEXTCLOUD_URL}/ocs/v2.php/apps/deck/api/v1.0"
+TALK_BOT_API = f"{NEXTCLOUD_URL}/ocs/v2.php/apps/spreed/api/v1/bot"
+TALK_ROOM_API = f"{NEXTCLOUD_URL}/ocs/v2.php/apps/spreed/api/v4/room"
+SHARES_API = f"{NEXTCLOUD_URL}/ocs/v2.php/apps/files_sharing/api/v1/shares"
 CLAUDE_PATH = os.environ.get('CLAUDE_PATH', 'claude')
 INSTALL_DIR = os.environ.get('INSTALL_DIR', '/opt/nextcloud-claude-bot')
-HISTORY_FILE = os.path.join(INSTALL_DIR, 'conversation_history.json')
-KEY_FACTS_FILE = os.path.join(INSTALL_DIR, 'key_facts.json')
+HISTORY_DB_FILE = os.path.join(INSTALL_DIR, 'conversation_history.db')
+HISTORY_FILE = os.path.join(INSTALL_DIR, 'conversation_history.json')  # Legacy, imported once into HISTORY_DB_FILE
+KEY_FACTS_FILE = os.path.join(INSTALL_DIR, 'key_facts.json')  # Legacy, imported once into HISTORY_DB_FILE
 MAX_HISTORY_MESSAGES = 50  # Verhoogd voor beter geheugen
 MAX_MESSAGE_LENGTH_IN_HISTORY = 500  # Truncate lange berichten in history
+HISTORY_TIME_FORMAT = "%d/%m %H:%M"  # Time shown per message in the history context
+MAX_KEY_FACTS = 20  # Per conversation
+MAX_MESSAGE_ATTEMPTS = 2  # A stored message that was cut off this often (e.g. it crashes the worker) is dropped
+INTENT_CONFIRM_COMPLETION = 'await_completion_confirm'  # History intent: bot asked to confirm completing the task
 
 # WhisperFlow configuration
 WHISPER_PYTHON = os.environ.get('WHISPER_PYTHON', '/opt/whisperflow/bin/python')
@@ -202,15 +352,105 @@ AUDIO_EXTENSIONS = ['.mp3', '.wav', '.ogg', '.m4a', '.flac', '.webm', '.opus']
 NEXTCLOUD_USER = os.environ.get('NEXTCLOUD_USER', '')
 NEXTCLOUD_PASSWORD = os.environ.get('NEXTCLOUD_PASSWORD', '')
 
+# Token for admin endpoints (sent as "Authorization: Bearer <token>"); they are disabled when unset
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+
+# Shared HTTP session: keeps TCP/TLS connections to Nextcloud and ERPNext alive between calls
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=20, pool_maxsize=50,
+                       max_retries=Retry(total=3, backoff_factor=0.3,
+                                         status_forcelist=[502, 503, 504], raise_on_status=False))
+SESSION.mount('https://', _adapter)
+SESSION.mount('http://', _adapter)
+SESSION.headers.update({'OCS-APIRequest': 'true'})
+# The session is shared by all bots with different credentials, so never keep cookies
+# (Nextcloud sets a session cookie on basic-auth calls that would otherwise leak to other bots)
+SESSION.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+
+# Worker pool for overlapping independent HTTP/DB calls
+EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
+# Worker pool that processes webhook messages after they have been acknowledged
+WEBHOOK_EXECUTOR = ThreadPoolExecutor(max_workers=16)
+# token -> deque of (row id, message) waiting for that conversation; a token is present while its drain task runs,
+# so each conversation uses at most one pool thread and its messages are handled in arrival order.
+# Webhooks are acknowledged before processing, so every queued message is also stored in the pending_messages
+# table until it is done; a restarted worker resumes them (at-least-once: a message cut off mid-reply may be
+# answered twice, and one that was already tried MAX_MESSAGE_ATTEMPTS times is given up on)
+_pending_messages = {}
+_pending_messages_lock = threading.Lock()
+
 # Conversation history storage
 conversation_history = {}
+_history_positions = {}  # token -> position of the next message in the history DB
+_total_messages = 0  # Messages held in conversation_history, kept up to date for /health
+_total_messages_lock = threading.Lock()
 key_facts = {}  # Per-conversation key facts that always get included
-history_lock = threading.Lock()
-facts_lock = threading.Lock()
+# Locks are per conversation token, so different chats don't wait on each other
+_history_locks = {}  # token -> RWLock for conversation_history[token]
+_facts_locks = {}  # token -> RWLock for key_facts[token]
+_locks_lock = threading.Lock()
+
+
+class RWLock:
+    """Lock shared by readers and held exclusively by one writer; waiting writers go before new readers"""
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+def _lock_for(registry, key, factory=threading.Lock):
+    """Return the lock for key in registry, creating it with factory on first use"""
+    lock = registry.get(key)
+    if lock is None:
+        with _locks_lock:
+            lock = registry.setdefault(key, factory())
+    return lock
 
 
 # ============== ERPNext API Helper Functions ==============
 
+# HTTP method -> bound session method, used by erpnext_request
+_METHODS = {
+    'GET': SESSION.get,
+    'POST': SESSION.post,
+    'PUT': SESSION.put,
+    'DELETE': SESSION.delete,
+}
+
+
 def erpnext_request(bot_config, method, endpoint, data=None):
     """Make an authenticated request to ERPNext API"""
     url = f"{ERPNEXT_URL}/api/{endpoint}"
@@ -220,17 +460,17 @@ def erpnext_request(bot_config, method, endpoint, data=None):
     }
 
     try:
+        send = _METHODS.get(method)
+        if send is None:
+            return None
         if method == 'GET':
-            resp = requests.get(url, headers=headers, params=data, timeout=30)
-        elif method == 'POST':
-            resp = requests.post(url, headers=headers, json=data, timeout=30)
-        elif method == 'PUT':
-            resp = requests.put(url, headers=headers, json=data, timeout=30)
+            resp = send(url, headers=headers, params=data, timeout=30)
         else:
-            return None
+            body = _dumps_bytes(data) if data is not None else None
+            resp = send(url, headers=headers, data=body, timeout=30)
 
         if resp.status_code == 200:
-            return resp.json()
+            return _loads(resp.content)
         else:
             print(f"ERPNext API error: {resp.status_code} - {resp.text}")
             return None
@@ -246,9 +486,9 @@ def get_erpnext_documents(bot_config, doctype, filters=None, fields=None, limit=
         'limit_page_length': limit
     }
     if filters:
-        params['filters'] = json.dumps(filters)
+        params['filters'] = _dumps(filters)
     if fields:
-        params['fields'] = json.dumps(fields)
+        params['fields'] = _dumps(fields)
 
     result = erpnext_request(bot_config, 'GET', 'resource/' + doctype, params)
     if result and 'data' in result:
@@ -256,6 +496,35 @@ def get_erpnext_documents(bot_config, doctype, filters=None, fields=None, limit=
     return []
 
 
+def get_erpnext_documents_bulk(bot_config, queries, max_workers=8):
+    """
+    Run several ERPNext list queries concurrently instead of one after another.
+
+    Args:
+        bot_config: Bot configuration with ERPNext credentials
+        queries: list of dicts with 'doctype' and optional 'filters', 'fields' and 'limit'
+        max_workers: Maximum number of requests in flight
+
+    Returns:
+        list with the documents for each query, in the same order as queries
+    """
+    if not queries:
+        return []
+
+    results = [[] for _ in queries]
+    # Each worker reuses a kept-alive connection from the shared session pool
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(queries))) as executor:
+        futures = {
+            executor.submit(get_erpnext_documents, bot_config, query['doctype'],
+                            query.get('filters'), query.get('fields'), query.get('limit', 10)): i
+            for i, query in enumerate(queries)
+        }
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+
+    return results
+
+
 def create_erpnext_document(bot_config, doctype, data):
     """Create a document in ERPNext"""
     result = erpnext_request(bot_config, 'POST', f'resource/{doctype}', data)
@@ -268,8 +537,8 @@ def update_erpnext_document(bot_config, doctype, name, data):
     return result
 
 
-def add_comment_to_erpnext(bot_config, doctype, docname, content, comment_by=None):
-    """Add a comment to an ERPNext document (for task conversation logging)"""
+def _post_erpnext_comment(bot_config, doctype, docname, comment_by, content):
+    """POST a comment to an ERPNext document"""
     comment_data = {
         'doctype': 'Comment',
         'comment_type': 'Comment',
@@ -277,7 +546,7 @@ def add_comment_to_erpnext(bot_config, doctype, docname, content, comment_by=Non
         'reference_name': docname,
         'content': content,
         'comment_email': bot_config['erpnext_user'],
-        'comment_by': comment_by or bot_config['erpnext_user']
+        'comment_by': comment_by
     }
     result = erpnext_request(bot_config, 'POST', 'resource/Comment', comment_data)
     if result:
@@ -287,8 +556,8 @@ def add_comment_to_erpnext(bot_config, doctype, docname, content, comment_by=Non
     return result
 
 
-def add_comment_to_deck_card(bot_config, board_id, stack_id, card_id, content):
-    """Add a comment to a Nextcloud Deck card"""
+def _post_deck_comment(bot_config, card_id, content):
+    """POST a comment to a Nextcloud Deck card"""
     try:
         headers = {
             'OCS-APIRequest': 'true',
@@ -297,10 +566,10 @@ def add_comment_to_deck_card(bot_config, board_id, stack_id, card_id, content):
         auth = (bot_config['nextcloud_user'], bot_config['nextcloud_password'])
 
         # Use OCS API endpoint - card_id is sufficient, board/stack not needed
-        url = f"{NEXTCLOUD_URL}/ocs/v2.php/apps/deck/api/v1.0/cards/{card_id}/comments"
+        url = f"{DECK_OCS_API}/cards/{card_id}/comments"
         data = {'message': content}
 
-        resp = requests.post(url, auth=auth, headers=headers, json=data, timeout=30)
+        resp = SESSION.post(url, auth=auth, headers=headers, data=_dumps_bytes(data), timeout=30)
 
         if resp.status_code in [200, 201]:
             print(f"Added comment to Deck card {card_id}")
@@ -313,6 +582,91 @@ def add_comment_to_deck_card(bot_config, board_id, stack_id, card_id, content):
         return False
 
 
+# Comments are posted by a background thread so the webhook doesn't wait on ERPNext/Deck.
+# Comments for the same target arriving within COMMENT_FLUSH_WINDOW are merged into one POST.
+COMMENT_FLUSH_WINDOW = 0.2  # seconds
+DECK_COMMENT_MAX_LENGTH = 1000
+_comment_queue = queue.Queue(maxsize=1000)
+_comment_thread = None
+_comment_thread_lock = threading.Lock()
+
+
+def _comment_worker():
+    """Collect queued comments for COMMENT_FLUSH_WINDOW, merge them per target and post them"""
+    while True:
+        item = _comment_queue.get()
+        deadline = time.monotonic() + COMMENT_FLUSH_WINDOW
+        batch = {}  # key -> (post function, args, list of merged contents)
+        while True:
+            key, post, args, content, max_length = item
+            if key not in batch:
+                batch[key] = (post, args, [content])
+            else:
+                contents = batch[key][2]
+                merged = f"{contents[-1]}\n\n{content}"
+                if max_length is None or len(merged) <= max_length:
+                    contents[-1] = merged
+                else:
+                    contents.append(content)
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = _comment_queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+
+        for post, args, contents in batch.values():
+            for content in contents:
+                try:
+                    post(*args, content)
+                except Exception as e:
+                    print(f"Error posting queued comment: {e}")
+
+
+def _enqueue_comment(key, post, args, content, max_length=None):
+    """Hand a comment to the background comment worker"""
+    global _comment_thread
+    with _comment_thread_lock:
+        if _comment_thread is None or not _comment_thread.is_alive():
+            _comment_thread = threading.Thread(target=_comment_worker, daemon=True)
+            _comment_thread.start()
+    _comment_queue.put((key, post, args, content, max_length))
+
+
+def add_comment_to_erpnext(bot_config, doctype, docname, content, comment_by=None):
+    """Queue a comment for an ERPNext document (for task conversation logging)"""
+    comment_by = comment_by or bot_config['erpnext_user']
+    _enqueue_comment(
+        ('erpnext', bot_config['erpnext_user'], doctype, docname, comment_by),
+        _post_erpnext_comment,
+        (bot_config, doctype, docname, comment_by),
+        content
+    )
+    return True
+
+
+def _truncate_for_deck(prefix, text):
+    """Return prefix + text, with text cut off and marked '...' so the whole comment fits DECK_COMMENT_MAX_LENGTH"""
+    max_len = DECK_COMMENT_MAX_LENGTH - len(prefix) - 3
+    if len(text) > max_len:
+        text = text[:max_len] + '...'
+    return prefix + text
+
+
+def add_comment_to_deck_card(bot_config, board_id, stack_id, card_id, content):
+    """Queue a comment for a Nextcloud Deck card"""
+    _enqueue_comment(
+        ('deck', bot_config['nextcloud_user'], card_id),
+        _post_deck_comment,
+        (bot_config, card_id),
+        content,
+        max_length=DECK_COMMENT_MAX_LENGTH
+    )
+    return True
+
+
 # ============== Nextcloud File Sharing Functions ==============
 
 def share_file_to_conversation(bot_config, file_path, conversation_token, caption=None):
@@ -344,11 +698,10 @@ def share_file_to_conversation(bot_config, file_path, conversation_token, captio
 
         # Add caption if provided
         if caption:
-            import json
             data['talkMetaData'] = json.dumps({'caption': caption})
 
-        url = f"{NEXTCLOUD_URL}/ocs/v2.php/apps/files_sharing/api/v1/shares"
-        resp = requests.post(url, auth=auth, headers=headers, data=data, timeout=30)
+        url = SHARES_API
+        resp = SESSION.post(url, auth=auth, headers=headers, data=data, timeout=30)
 
         print(f"Share file response: {resp.status_code}")
 
@@ -364,14 +717,15 @@ def share_file_to_conversation(bot_config, file_path, conversation_token, captio
             return None
     except Exception as e:
         print(f"Error sharing file: {e}")
-        import traceback
         traceback.print_exc()
         return None
 
 
 def search_nextcloud_files(bot_config, search_query, limit=10):
     """
-    Search for files in Nextcloud using WebDAV PROPFIND with client-side filtering.
+    Search for files in Nextcloud using the WebDAV SEARCH method (server-side filtering).
+    Falls back to a PROPFIND of the whole tree with client-side filtering
+    when the server doesn't support SEARCH.
 
     Args:
         bot_config: Bot configuration
@@ -382,12 +736,49 @@ def search_nextcloud_files(bot_config, search_query, limit=10):
         list of dicts with file info (path, name, size, type)
     """
     try:
-        import xml.etree.ElementTree as ET
-
         auth = (bot_config['nextcloud_user'], bot_config['nextcloud_password'])
-        propfind_url = f"{NEXTCLOUD_URL}/remote.php/dav/files/{bot_config['nextcloud_user']}/"
 
-        propfind_body = '''<?xml version="1.0"?>
+        search_body = f'''<?xml version="1.0" encoding="UTF-8"?>
+<d:searchrequest xmlns:d="DAV:">
+  <d:basicsearch>
+    <d:select>
+      <d:prop>
+        <d:displayname/>
+        <d:getcontentlength/>
+        <d:getcontenttype/>
+        <d:resourcetype/>
+      </d:prop>
+    </d:select>
+    <d:from>
+      <d:scope>
+        <d:href>/files/{escape(bot_config['nextcloud_user'])}</d:href>
+        <d:depth>infinity</d:depth>
+      </d:scope>
+    </d:from>
+    <d:where>
+      <d:and>
+        <d:like>
+          <d:prop><d:displayname/></d:prop>
+          <d:literal>%{escape(search_query)}%</d:literal>
+        </d:like>
+        <d:not><d:is-collection/></d:not>
+      </d:and>
+    </d:where>
+    <d:orderby/>
+    <d:limit>
+      <d:nresults>{int(limit)}</d:nresults>
+    </d:limit>
+  </d:basicsearch>
+</d:searchrequest>'''
+
+        headers = {'Content-Type': 'text/xml; charset=utf-8'}
+        resp = SESSION.request('SEARCH', DAV_ROOT, auth=auth, headers=headers,
+                               data=search_body.encode('utf-8'), timeout=60)
+
+        if resp.status_code == 501:
+            # SEARCH not implemented - list the full tree and filter client-side
+            propfind_url = f"{DAV_FILES}{bot_config['nextcloud_user']}/"
+            propfind_body = '''<?xml version="1.0"?>
 <d:propfind xmlns:d="DAV:">
   <d:prop>
     <d:displayname/>
@@ -397,28 +788,32 @@ def search_nextcloud_files(bot_config, search_query, limit=10):
   </d:prop>
 </d:propfind>'''
 
-        headers = {'Content-Type': 'application/xml', 'Depth': 'infinity'}
-        resp = requests.request('PROPFIND', propfind_url, auth=auth, headers=headers,
-                               data=propfind_body, timeout=60)
+            headers = {'Content-Type': 'application/xml', 'Depth': 'infinity'}
+            resp = SESSION.request('PROPFIND', propfind_url, auth=auth, headers=headers,
+                                   data=propfind_body, timeout=60)
 
         results = []
         if resp.status_code == 207:  # Multi-Status
-            root = ET.fromstring(resp.text)
             ns = {'d': 'DAV:'}
             search_lower = search_query.lower()
+            user_prefix = f"/remote.php/dav/files/{bot_config['nextcloud_user']}"
+
+            # Stream through the multistatus body one <d:response> at a time,
+            # freeing each subtree once handled and stopping at the limit
+            for _, response in ET.iterparse(io.BytesIO(resp.content), events=('end',)):
+                if response.tag != '{DAV:}response':
+                    continue
 
-            for response in root.findall('.//d:response', ns):
                 href = response.find('d:href', ns)
                 if href is not None:
                     path = urllib.parse.unquote(href.text)
-                    user_prefix = f"/remote.php/dav/files/{bot_config['nextcloud_user']}"
-                    if user_prefix in path:
-                        file_path = path.replace(user_prefix, '')
+                    _, found, file_path = path.partition(user_prefix)
+                    if found:
 
                         # Check if matches search term
                         if search_lower in file_path.lower():
                             propstat = response.find('d:propstat', ns)
-                            if propstat:
+                            if propstat is not None:
                                 prop = propstat.find('d:prop', ns)
                                 resourcetype = prop.find('d:resourcetype', ns) if prop is not None else None
                                 is_folder = resourcetype is not None and len(resourcetype) > 0
@@ -435,14 +830,14 @@ def search_nextcloud_files(bot_config, search_query, limit=10):
                                         'type': contenttype.text if contenttype is not None else 'unknown'
                                     })
 
-                                    if len(results) >= limit:
-                                        break
+                response.clear()
+                if len(results) >= limit:
+                    break
 
         return results[:limit]
 
     except Exception as e:
         print(f"Error searching files: {e}")
-        import traceback
         traceback.print_exc()
         return []
 
@@ -465,8 +860,8 @@ def search_and_share_file(bot_config, search_query, conversation_token, caption=
 
         # First try exact path
         if search_query.startswith('/'):
-            webdav_url = f"{NEXTCLOUD_URL}/remote.php/dav/files/{bot_config['nextcloud_user']}{search_query}"
-            resp = requests.head(webdav_url, auth=auth, timeout=10)
+            webdav_url = f"{DAV_FILES}{bot_config['nextcloud_user']}{search_query}"
+            resp = SESSION.head(webdav_url, auth=auth, timeout=10)
 
             if resp.status_code == 200:
                 # File exists at exact path
@@ -523,22 +918,19 @@ def upload_file_to_nextcloud(bot_config, local_path, nc_path=None):
             create_nextcloud_folder(bot_config, nc_dir)
 
         auth = (bot_config['nextcloud_user'], bot_config['nextcloud_password'])
-        webdav_url = f"{NEXTCLOUD_URL}/remote.php/dav/files/{bot_config['nextcloud_user']}{nc_path}"
-
-        # Read file content
-        with open(local_path, 'rb') as f:
-            content = f.read()
+        webdav_url = f"{DAV_FILES}{bot_config['nextcloud_user']}{nc_path}"
 
         # Determine content type
-        import mimetypes
         content_type, _ = mimetypes.guess_type(local_path)
         if not content_type:
             content_type = 'application/octet-stream'
 
-        headers = {'Content-Type': content_type}
+        size = os.path.getsize(local_path)
+        headers = {'Content-Type': content_type, 'Content-Length': str(size)}
 
-        # Upload via WebDAV PUT
-        resp = requests.put(webdav_url, auth=auth, headers=headers, data=content, timeout=60)
+        # Upload via WebDAV PUT, streaming the file from disk instead of reading it into memory
+        with open(local_path, 'rb') as f:
+            resp = SESSION.put(webdav_url, auth=auth, headers=headers, data=f, timeout=300)
 
         print(f"Upload file response: {resp.status_code} for {nc_path}")
 
@@ -549,36 +941,58 @@ def upload_file_to_nextcloud(bot_config, local_path, nc_path=None):
                 'local_path': local_path,
                 'nc_path': nc_path,
                 'filename': filename,
-                'size': len(content)
+                'size': size
             }
         else:
             print(f"Failed to upload file: {resp.status_code} - {resp.text[:500]}")
             return None
     except Exception as e:
         print(f"Error uploading file: {e}")
-        import traceback
         traceback.print_exc()
         return None
 
 
+# WebDAV folder URLs known to exist, so uploads skip the MKCOL round trips
+_known_folders = set()
+_known_folders_lock = threading.Lock()
+
+
 def create_nextcloud_folder(bot_config, folder_path):
     """Create a folder in Nextcloud via WebDAV MKCOL"""
     try:
         auth = (bot_config['nextcloud_user'], bot_config['nextcloud_password'])
+        folder_url = f"{DAV_FILES}{bot_config['nextcloud_user']}/{folder_path.strip('/')}"
+
+        with _known_folders_lock:
+            if folder_url in _known_folders:
+                return True
+
+        # Check the leaf folder first - usually it already exists
+        resp = SESSION.request('PROPFIND', folder_url, auth=auth, headers={'Depth': '0'}, timeout=5)
+        if resp.status_code == 207:
+            with _known_folders_lock:
+                _known_folders.add(folder_url)
+            return True
 
         # Create folders recursively
         parts = folder_path.strip('/').split('/')
         current_path = ''
+        created = True
 
         for part in parts:
             current_path += '/' + part
-            webdav_url = f"{NEXTCLOUD_URL}/remote.php/dav/files/{bot_config['nextcloud_user']}{current_path}"
+            webdav_url = f"{DAV_FILES}{bot_config['nextcloud_user']}{current_path}"
 
             # Try to create folder
-            resp = requests.request('MKCOL', webdav_url, auth=auth, timeout=10)
+            resp = SESSION.request('MKCOL', webdav_url, auth=auth, timeout=10)
             # 201 = created, 405 = already exists
             if resp.status_code not in [201, 405]:
                 print(f"Warning: Could not create folder {current_path}: {resp.status_code}")
+                created = False
+
+        if created:
+            with _known_folders_lock:
+                _known_folders.add(folder_url)
 
         return True
     except Exception as e:
@@ -630,6 +1044,19 @@ def upload_and_share_file(bot_config, local_path, conversation_token, nc_path=No
         }
 
 
+# Common patterns for file creation in Claude's responses
+FILE_MENTION_PATTERNS = [
+    r'(?:created?|wrote|saved|generated?|made)\s+(?:the\s+)?(?:file\s+)?[`"\']?(/[^\s`"\']+\.[a-zA-Z0-9]+)[`"\']?',
+    r'(?:file|bestand)\s+[`"\']?(/[^\s`"\']+\.[a-zA-Z0-9]+)[`"\']?\s+(?:is\s+)?(?:created?|aangemaakt|geschreven)',
+    r'[`"\'](/home/[^\s`"\']+\.[a-zA-Z0-9]+)[`"\']',
+    r'[`"\'](/opt/[^\s`"\']+\.[a-zA-Z0-9]+)[`"\']',
+    r'[`"\'](/tmp/[^\s`"\']+\.[a-zA-Z0-9]+)[`"\']',
+]
+
+# All patterns in one regex so the response is scanned once; each alternative has one group
+_FILE_MENTION_RE = re.compile('|'.join(f'(?:{p})' for p in FILE_MENTION_PATTERNS), re.IGNORECASE)
+
+
 def detect_files_in_response(response_text):
     """
     Detect file paths mentioned in Claude's response that might be new files.
@@ -638,26 +1065,41 @@ def detect_files_in_response(response_text):
     Returns:
         list of potential file paths
     """
-    import re
+    # Deduplicate (keeping first-seen order) before touching the filesystem
+    candidates = dict.fromkeys(m.group(m.lastindex) for m in _FILE_MENTION_RE.finditer(response_text))
+    return [path for path in candidates if os.path.exists(path)]
+
 
-    files = []
+# ============== Optional Dependencies ==============
+# Heavy document/browser libraries are only imported when first needed and the
+# module is cached afterwards; a missing package still raises ImportError.
 
-    # Common patterns for file creation
-    patterns = [
-        r'(?:created?|wrote|saved|generated?|made)\s+(?:the\s+)?(?:file\s+)?[`"\']?(/[^\s`"\']+\.[a-zA-Z0-9]+)[`"\']?',
-        r'(?:file|bestand)\s+[`"\']?(/[^\s`"\']+\.[a-zA-Z0-9]+)[`"\']?\s+(?:is\s+)?(?:created?|aangemaakt|geschreven)',
-        r'[`"\'](/home/[^\s`"\']+\.[a-zA-Z0-9]+)[`"\']',
-        r'[`"\'](/opt/[^\s`"\']+\.[a-zA-Z0-9]+)[`"\']',
-        r'[`"\'](/tmp/[^\s`"\']+\.[a-zA-Z0-9]+)[`"\']',
-    ]
+@lru_cache(maxsize=None)
+def _fitz():
+    """PyMuPDF"""
+    import fitz
+    return fitz
 
-    for pattern in patterns:
-        matches = re.findall(pattern, response_text, re.IGNORECASE)
-        for match in matches:
-            if match not in files and os.path.exists(match):
-                files.append(match)
 
-    return files
+@lru_cache(maxsize=None)
+def _odf():
+    """odfpy loader, text and teletype modules"""
+    from odf import opendocument, teletype, text
+    return opendocument, text, teletype
+
+
+@lru_cache(maxsize=None)
+def _docx():
+    """python-docx"""
+    import docx
+    return docx
+
+
+@lru_cache(maxsize=None)
+def _sync_playwright():
+    """Playwright sync API entry point"""
+    from playwright.sync_api import sync_playwright
+    return sync_playwright
 
 
 # ============== Document Preview Functions ==============
@@ -675,19 +1117,29 @@ def extract_pdf_text(file_path, max_pages=5, max_chars=3000):
         dict with text content and metadata
     """
     try:
-        import fitz  # PyMuPDF
+        fitz = _fitz()
 
         doc = fitz.open(file_path)
-        total_pages = len(doc)
-        text_parts = []
-
-        for page_num in range(min(max_pages, total_pages)):
-            page = doc[page_num]
-            text = page.get_text()
-            if text.strip():
-                text_parts.append(f"--- Pagina {page_num + 1} ---\n{text.strip()}")
-
-        doc.close()
+        try:
+            total_pages = len(doc)
+            text_parts = []
+            total_chars = 0
+            pages_extracted = 0
+            # Plain text extraction; ligature fidelity doesn't matter for a preview
+            text_flags = fitz.TEXTFLAGS_TEXT & ~fitz.TEXT_PRESERVE_LIGATURES
+
+            for page_num in range(min(max_pages, total_pages)):
+                page = doc.load_page(page_num)
+                text = page.get_text("text", flags=text_flags).strip()
+                pages_extracted += 1
+                if text:
+                    text_parts.append(f"--- Pagina {page_num + 1} ---\n{text}")
+                    total_chars += len(text_parts[-1]) + 2
+                    # Everything past max_chars is cut off anyway
+                    if total_chars > max_chars:
+                        break
+        finally:
+            doc.close()
 
         full_text = "\n\n".join(text_parts)
         if len(full_text) > max_chars:
@@ -697,7 +1149,7 @@ def extract_pdf_text(file_path, max_pages=5, max_chars=3000):
             'success': True,
             'text': full_text,
             'total_pages': total_pages,
-            'pages_extracted': min(max_pages, total_pages),
+            'pages_extracted': pages_extracted,
             'type': 'pdf'
         }
     except ImportError:
@@ -718,25 +1170,21 @@ def extract_odt_text(file_path, max_chars=3000):
         dict with text content and metadata
     """
     try:
-        from odf import text as odf_text
-        from odf.opendocument import load
+        opendocument, odf_text, teletype = _odf()
 
-        doc = load(file_path)
+        doc = opendocument.load(file_path)
         paragraphs = doc.getElementsByType(odf_text.P)
 
         text_parts = []
+        total_chars = 0
         for para in paragraphs:
-            # Extract text from paragraph
-            para_text = ""
-            for node in para.childNodes:
-                if node.nodeType == node.TEXT_NODE:
-                    para_text += node.data
-                elif hasattr(node, 'childNodes'):
-                    for child in node.childNodes:
-                        if child.nodeType == child.TEXT_NODE:
-                            para_text += child.data
-            if para_text.strip():
-                text_parts.append(para_text.strip())
+            para_text = teletype.extractText(para).strip()
+            if para_text:
+                text_parts.append(para_text)
+                total_chars += len(para_text) + 2
+                # Everything past max_chars is cut off anyway
+                if total_chars > max_chars:
+                    break
 
         full_text = "\n\n".join(text_parts)
         if len(full_text) > max_chars:
@@ -766,9 +1214,9 @@ def extract_docx_text(file_path, max_chars=3000):
         dict with text content and metadata
     """
     try:
-        from docx import Document
+        docx = _docx()
 
-        doc = Document(file_path)
+        doc = docx.Document(file_path)
         text_parts = []
 
         for para in doc.paragraphs:
@@ -791,6 +1239,16 @@ def extract_docx_text(file_path, max_chars=3000):
         return {'success': False, 'error': str(e)}
 
 
+# Text extractors per document extension
+_PREVIEW_DISPATCH = {
+    '.pdf': extract_pdf_text,
+    '.odt': extract_odt_text,
+    '.docx': extract_docx_text,
+}
+
+_PREVIEWABLE_EXTS = frozenset({'.pdf', '.odt', '.docx', '.html', '.htm'})
+
+
 def preview_document(file_path, max_chars=3000):
     """
     Preview a document file (PDF, ODT, DOCX).
@@ -807,22 +1265,57 @@ def preview_document(file_path, max_chars=3000):
 
     filename = os.path.basename(file_path).lower()
 
-    if filename.endswith('.pdf'):
-        return extract_pdf_text(file_path, max_chars=max_chars)
-    elif filename.endswith('.odt'):
-        return extract_odt_text(file_path, max_chars=max_chars)
-    elif filename.endswith('.docx'):
-        return extract_docx_text(file_path, max_chars=max_chars)
-    else:
+    extractor = _PREVIEW_DISPATCH.get(os.path.splitext(filename)[1])
+    if extractor is None:
         return {'success': False, 'error': f'Niet-ondersteund bestandstype: {filename}'}
+    return extractor(file_path, max_chars=max_chars)
 
 
 def is_previewable_document(filename):
     """Check if a file is a previewable document"""
     if not filename:
         return False
-    lower = filename.lower()
-    return lower.endswith('.pdf') or lower.endswith('.odt') or lower.endswith('.docx') or lower.endswith('.html') or lower.endswith('.htm')
+    return os.path.splitext(filename)[1].lower() in _PREVIEWABLE_EXTS
+
+
+# Screenshots run on one dedicated thread: sync Playwright objects can only be used
+# from the thread that started them, so the browser is launched there once and reused
+_screenshot_queue = queue.Queue()
+_screenshot_thread = None
+_screenshot_thread_lock = threading.Lock()
+
+
+def _screenshot_worker():
+    """Keep a headless Chromium running and take the screenshots queued by screenshot_html"""
+    sync_playwright = _sync_playwright()
+
+    playwright = None
+    browser = None
+    while True:
+        url, output_path, width, height, future = _screenshot_queue.get()
+        try:
+            if browser is None or not browser.is_connected():
+                if playwright is None:
+                    playwright = sync_playwright().start()
+                browser = playwright.chromium.launch(headless=True)
+
+            # Fresh context per screenshot so pages don't share state
+            context = browser.new_context(viewport={'width': width, 'height': height})
+            try:
+                page = context.new_page()
+                page.goto(url, wait_until='networkidle', timeout=30000)
+
+                # Wait a bit for any animations/rendering
+                page.wait_for_timeout(500)
+
+                # Take full page screenshot or viewport screenshot
+                page.screenshot(path=output_path, full_page=True)
+            finally:
+                context.close()
+
+            future.set_result(output_path)
+        except Exception as e:
+            future.set_exception(e)
 
 
 def screenshot_html(file_path, output_path=None, width=1200, height=800):
@@ -838,8 +1331,9 @@ def screenshot_html(file_path, output_path=None, width=1200, height=800):
     Returns:
         dict with screenshot path on success
     """
+    global _screenshot_thread
     try:
-        from playwright.sync_api import sync_playwright
+        _sync_playwright()  # Fail early if Playwright is missing
 
         if output_path is None:
             output_path = tempfile.mktemp(suffix='.png')
@@ -852,17 +1346,14 @@ def screenshot_html(file_path, output_path=None, width=1200, height=800):
         else:
             url = f"file://{os.path.abspath(file_path)}"
 
-        with sync_playwright() as p:
-            browser = p.chromium.launch(headless=True)
-            page = browser.new_page(viewport={'width': width, 'height': height})
-            page.goto(url, wait_until='networkidle', timeout=30000)
-
-            # Wait a bit for any animations/rendering
-            page.wait_for_timeout(500)
+        with _screenshot_thread_lock:
+            if _screenshot_thread is None or not _screenshot_thread.is_alive():
+                _screenshot_thread = threading.Thread(target=_screenshot_worker, daemon=True)
+                _screenshot_thread.start()
 
-            # Take full page screenshot or viewport screenshot
-            page.screenshot(path=output_path, full_page=True)
-            browser.close()
+        future = Future()
+        _screenshot_queue.put((url, output_path, width, height, future))
+        future.result(timeout=90)
 
         return {
             'success': True,
@@ -911,17 +1402,77 @@ def download_and_preview_document(file_url, nc_user, nc_password, max_chars=3000
 
 # ============== Deck API Functions ==============
 
+# Boards and stacks rarely change, so keep them per Nextcloud user for DECK_CACHE_TTL.
+# The cache is written to DECK_CACHE_FILE on shutdown so a restart starts warm.
+DECK_CACHE_TTL = 300  # seconds
+DECK_CACHE_FILE = os.path.join(INSTALL_DIR, 'deck_cache.json')
+_deck_cache = {'boards': {}, 'stacks': {}}  # user / "user/board_id" -> (fetched_at, data)
+_deck_cache_lock = threading.Lock()
+
+
+def _deck_cache_get(kind, key):
+    """Return cached Deck data if it is younger than DECK_CACHE_TTL, else None"""
+    with _deck_cache_lock:
+        entry = _deck_cache[kind].get(key)
+    if entry and time.time() - entry[0] < DECK_CACHE_TTL:
+        return entry[1]
+    return None
+
+
+def _deck_cache_put(kind, key, data):
+    with _deck_cache_lock:
+        _deck_cache[kind][key] = (time.time(), data)
+
+
+def clear_deck_cache():
+    """Forget all cached boards and stacks"""
+    with _deck_cache_lock:
+        _deck_cache['boards'].clear()
+        _deck_cache['stacks'].clear()
+
+
+def load_deck_cache():
+    """Load the Deck cache written by save_deck_cache"""
+    try:
+        if os.path.exists(DECK_CACHE_FILE):
+            with open(DECK_CACHE_FILE, 'rb') as f:
+                data = _loads(f.read())
+            with _deck_cache_lock:
+                for kind in ('boards', 'stacks'):
+                    _deck_cache[kind] = {key: tuple(entry) for key, entry in data.get(kind, {}).items()}
+    except Exception as e:
+        print(f"Error loading Deck cache: {e}")
+
+
+def save_deck_cache():
+    """Write the Deck cache to disk"""
+    try:
+        with _deck_cache_lock:
+            body = _dumps_bytes(_deck_cache)
+        tmp_file = DECK_CACHE_FILE + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_file, DECK_CACHE_FILE)
+    except Exception as e:
+        print(f"Error saving Deck cache: {e}")
+
+
 def get_deck_boards(bot_config):
     """Get all Deck boards for the user"""
+    cached = _deck_cache_get('boards', bot_config['nextcloud_user'])
+    if cached is not None:
+        return cached
     try:
         headers = {'OCS-APIRequest': 'true', 'Content-Type': 'application/json'}
         auth = (bot_config['nextcloud_user'], bot_config['nextcloud_password'])
 
-        url = f"{NEXTCLOUD_URL}/index.php/apps/deck/api/v1.0/boards"
-        resp = requests.get(url, auth=auth, headers=headers, timeout=30)
+        url = f"{DECK_API}/boards"
+        resp = SESSION.get(url, auth=auth, headers=headers, timeout=30)
 
         if resp.status_code == 200:
-            return resp.json()
+            boards = resp.json()
+            _deck_cache_put('boards', bot_config['nextcloud_user'], boards)
+            return boards
         return []
     except Exception as e:
         print(f"Error getting boards: {e}")
@@ -930,15 +1481,21 @@ def get_deck_boards(bot_config):
 
 def get_deck_stacks(bot_config, board_id):
     """Get all stacks (columns) for a board"""
+    cache_key = f"{bot_config['nextcloud_user']}/{board_id}"
+    cached = _deck_cache_get('stacks', cache_key)
+    if cached is not None:
+        return cached
     try:
         headers = {'OCS-APIRequest': 'true', 'Content-Type': 'application/json'}
         auth = (bot_config['nextcloud_user'], bot_config['nextcloud_password'])
 
-        url = f"{NEXTCLOUD_URL}/index.php/apps/deck/api/v1.0/boards/{board_id}/stacks"
-        resp = requests.get(url, auth=auth, headers=headers, timeout=30)
+        url = f"{DECK_API}/boards/{board_id}/stacks"
+        resp = SESSION.get(url, auth=auth, headers=headers, timeout=30)
 
         if resp.status_code == 200:
-            return resp.json()
+            stacks = resp.json()
+            _deck_cache_put('stacks', cache_key, stacks)
+            return stacks
         return []
     except Exception as e:
         print(f"Error getting stacks: {e}")
@@ -961,8 +1518,8 @@ def create_deck_card(bot_config, board_id, stack_id, title, description=None, du
         if due_date:
             data['duedate'] = due_date
 
-        url = f"{NEXTCLOUD_URL}/index.php/apps/deck/api/v1.0/boards/{board_id}/stacks/{stack_id}/cards"
-        resp = requests.post(url, auth=auth, headers=headers, json=data, timeout=30)
+        url = f"{DECK_API}/boards/{board_id}/stacks/{stack_id}/cards"
+        resp = SESSION.post(url, auth=auth, headers=headers, json=data, timeout=30)
 
         print(f"Create card response: {resp.status_code}")
 
@@ -970,6 +1527,9 @@ def create_deck_card(bot_config, board_id, stack_id, title, description=None, du
             return resp.json()
         else:
             print(f"Failed to create card: {resp.text[:500]}")
+            # The cached board/stack may be gone; fetch it again next time
+            with _deck_cache_lock:
+                _deck_cache['stacks'].pop(f"{bot_config['nextcloud_user']}/{board_id}", None)
             return None
     except Exception as e:
         print(f"Error creating card: {e}")
@@ -986,23 +1546,25 @@ def find_or_create_task(bot_config, title, description=None, board_name=None):
         if not boards:
             return {'error': 'Geen Deck boards gevonden'}
 
-        # Find board by name or use first one
-        target_board = None
+        # Find boards by name or use first one (usually personal board)
+        candidates = []
         if board_name:
-            for board in boards:
-                if board_name.lower() in board.get('title', '').lower():
-                    target_board = board
-                    break
-
-        if not target_board:
-            # Use first board (usually personal board)
-            target_board = boards[0]
+            candidates = [b for b in boards if board_name.lower() in b.get('title', '').lower()][:3]
+        if not candidates:
+            candidates = [boards[0]]
+
+        # Fetch the stacks of all candidate boards at once; use the first board that has stacks
+        futures = [EXECUTOR.submit(get_deck_stacks, bot_config, board['id']) for board in candidates]
+        target_board, stacks = candidates[0], []
+        for board, future in zip(candidates, futures):
+            board_stacks = future.result()
+            if board_stacks:
+                target_board, stacks = board, board_stacks
+                break
 
         board_id = target_board['id']
         board_title = target_board.get('title', 'Unknown')
 
-        # Get stacks for this board
-        stacks = get_deck_stacks(bot_config, board_id)
         if not stacks:
             return {'error': f'Geen kolommen gevonden in board "{board_title}"'}
 
@@ -1042,37 +1604,49 @@ def find_or_create_task(bot_config, title, description=None, board_name=None):
 
 # ============== WhisperFlow Transcription Functions ==============
 
+_AUDIO_EXT_TUPLE = tuple(ext.lower() for ext in AUDIO_EXTENSIONS)
+_VOICE_MESSAGE_TYPES = frozenset({'voice-message', 'record-audio'})
+_FILE_PATTERN_RE = re.compile(r'\{file:(\d+)\|name:([^}]+)\}')  # {file:XXX|name:filename.mp3}
+
+
+@lru_cache(maxsize=256)
+def _quote_name(file_name):
+    """URL-encode a single file name for a WebDAV URL, including any '/'"""
+    return urllib.parse.quote(file_name, safe='')
+
+
 def is_audio_file(filename):
     """Check if filename has an audio extension"""
     if not filename:
         return False
-    return any(filename.lower().endswith(ext) for ext in AUDIO_EXTENSIONS)
+    return filename.lower().endswith(_AUDIO_EXT_TUPLE)
 
 
 def download_nextcloud_file(file_url, nc_user=None, nc_password=None):
     """Download a file from Nextcloud and return local path"""
     try:
-        print(f"[DEBUG] Downloading file from: {file_url}")
+        log.debug("Downloading file from: %s", file_url)
 
         # Use provided credentials or defaults
         user = nc_user or NEXTCLOUD_USER
         password = nc_password or NEXTCLOUD_PASSWORD
-        print(f"[DEBUG] Using credentials for user: {user}")
+        log.debug("Using credentials for user: %s", user)
 
         # Check if this is a public share link (no auth needed)
         if '/s/' in file_url:
             # Public share link - no authentication needed
-            response = requests.get(file_url, timeout=60, allow_redirects=True)
+            response = SESSION.get(file_url, timeout=60, allow_redirects=True, stream=True)
         else:
             # WebDAV URL - needs authentication
             auth = (user, password)
-            response = requests.get(file_url, auth=auth, timeout=60)
+            response = SESSION.get(file_url, auth=auth, timeout=60, stream=True)
 
-        print(f"[DEBUG] Download response status: {response.status_code}")
+        log.debug("Download response status: %s", response.status_code)
 
         if response.status_code != 200:
             print(f"Failed to download file: {response.status_code}")
-            print(f"[DEBUG] Response: {response.text[:500] if response.text else 'empty'}")
+            log.debug("Response: %s", response.text[:500] if response.text else 'empty')
+            response.close()
             return None
 
         # Determine extension from URL or content type
@@ -1088,42 +1662,90 @@ def download_nextcloud_file(file_url, nc_user=None, nc_password=None):
             else:
                 ext = '.mp3'  # Default for Talk recordings
 
-        with tempfile.NamedTemporaryFile(suffix=ext, delete=False) as f:
-            f.write(response.content)
-            print(f"[DEBUG] Downloaded {len(response.content)} bytes to {f.name}")
+        # Stream to disk instead of holding the whole file in memory
+        with response, tempfile.NamedTemporaryFile(suffix=ext, delete=False) as f:
+            for chunk in response.iter_content(chunk_size=1 << 16):
+                f.write(chunk)
+            log.debug("Downloaded %s bytes to %s", f.tell(), f.name)
             return f.name
     except Exception as e:
         print(f"Error downloading file: {e}")
-        import traceback
         traceback.print_exc()
         return None
 
 
-def transcribe_audio(audio_path):
-    """Transcribe audio file using WhisperFlow/Whisper"""
-    try:
-        # Use whisper directly for transcription
-        script = f'''
-import whisper
+# Whisper runs in one long-lived worker process so the model is loaded only once.
+# The worker reads {"path": ...} lines on stdin and answers each with {"text": ...} or {"error": ...}.
+WHISPER_WORKER_SCRIPT = '''
+import json
 import sys
-model = whisper.load_model("{WHISPER_MODEL}")
-result = model.transcribe("{audio_path}", language="nl")
-print(result["text"])
+import whisper
+
+out = sys.stdout
+sys.stdout = sys.stderr  # Keep stray prints out of the reply channel
+model = whisper.load_model(sys.argv[1])
+for line in sys.stdin:
+    try:
+        result = model.transcribe(json.loads(line)["path"], language="nl")
+        reply = {"text": result["text"]}
+    except Exception as e:
+        reply = {"error": str(e)}
+    out.write(json.dumps(reply) + "\\n")
+    out.flush()
 '''
-        result = subprocess.run(
-            [WHISPER_PYTHON, '-c', script],
-            capture_output=True,
+WHISPER_TIMEOUT = 300  # 5 minutes max per transcription
+_whisper_proc = None
+_whisper_replies = None
+_whisper_lock = threading.Lock()
+
+
+def _whisper_reader(proc, replies):
+    """Forward the worker's reply lines to its queue; None marks that the worker exited"""
+    for line in proc.stdout:
+        replies.put(line)
+    replies.put(None)
+
+
+def _get_whisper_worker():
+    """Return the Whisper worker and its reply queue, (re)starting it if needed (call with _whisper_lock held)"""
+    global _whisper_proc, _whisper_replies
+    if _whisper_proc is None or _whisper_proc.poll() is not None:
+        _whisper_proc = subprocess.Popen(
+            [WHISPER_PYTHON, '-c', WHISPER_WORKER_SCRIPT, WHISPER_MODEL],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
             text=True,
-            timeout=300  # 5 minutes max
+            bufsize=1
         )
+        _whisper_replies = queue.Queue()
+        threading.Thread(target=_whisper_reader, args=(_whisper_proc, _whisper_replies), daemon=True).start()
+    return _whisper_proc, _whisper_replies
 
-        if result.returncode == 0:
-            return result.stdout.strip()
-        else:
-            print(f"Whisper error: {result.stderr}")
+
+def transcribe_audio(audio_path):
+    """Transcribe audio file using WhisperFlow/Whisper"""
+    try:
+        with _whisper_lock:
+            proc, replies = _get_whisper_worker()
+            proc.stdin.write(_dumps({'path': audio_path}) + '\n')
+            proc.stdin.flush()
+            try:
+                line = replies.get(timeout=WHISPER_TIMEOUT)
+            except queue.Empty:
+                # Stuck worker; the next transcription starts a fresh one
+                proc.kill()
+                proc.wait()
+                print("Whisper error: transcription timed out")
+                return None
+
+        if line is None:
+            print("Whisper error: worker process exited")
             return None
-    except subprocess.TimeoutExpired:
-        return None
+        reply = _loads(line)
+        if 'error' in reply:
+            print(f"Whisper error: {reply['error']}")
+            return None
+        return reply['text'].strip()
     except Exception as e:
         print(f"Transcription error: {e}")
         return None
@@ -1139,42 +1761,50 @@ print(result["text"])
 def extract_file_info(message_data, message_parameters=None):
     """Extract file information from a Nextcloud Talk message"""
     # Debug: log the full webhook data structure
-    print(f"[DEBUG] Full webhook data keys: {message_data.keys()}")
-    print(f"[DEBUG] Message parameters passed: {message_parameters}")
+    log.debug("Full webhook data keys: %s", message_data.keys())
+    log.debug("Message parameters passed: %s", message_parameters)
 
     obj = message_data.get('object', {})
-    print(f"[DEBUG] Object keys: {obj.keys()}")
+    obj_get = obj.get
+    log.debug("Object keys: %s", obj.keys())
+
+    # Plain text message: no parameters, no file pattern and no audio type, so nothing below can match
+    if (not message_parameters and not obj_get('parameters')
+            and '{file:' not in obj_get('content', '')
+            and obj_get('messageType', '') not in _VOICE_MESSAGE_TYPES
+            and not (obj_get('mediaType') or '').startswith('audio/')):
+        return None
 
     # Check for voice message (Talk voice recordings)
     # Voice messages have messageType = 'voice-message' or 'record-audio'
-    message_type = obj.get('messageType', '')
-    print(f"[DEBUG] Message type: {message_type}")
+    message_type = obj_get('messageType', '')
+    log.debug("Message type: %s", message_type)
 
-    if message_type in ['voice-message', 'record-audio']:
+    if message_type in _VOICE_MESSAGE_TYPES:
         # Voice message - get the file URL
-        file_url = obj.get('id', '')
-        file_name = obj.get('name', 'voice.ogg')
-        print(f"[DEBUG] Voice message detected: {file_url}")
+        file_url = obj_get('id', '')
+        file_name = obj_get('name', 'voice.ogg')
+        log.debug("Voice message detected: %s", file_url)
         return {'url': file_url, 'name': file_name, 'type': 'audio'}
 
     # Check mediaType field
-    media_type = obj.get('mediaType', '')
-    print(f"[DEBUG] Media type: {media_type}")
+    media_type = obj_get('mediaType', '')
+    log.debug("Media type: %s", media_type)
 
     if media_type and media_type.startswith('audio/'):
-        file_url = obj.get('id', '')
-        file_name = obj.get('name', '')
-        print(f"[DEBUG] Audio media type detected: {file_url}")
+        file_url = obj_get('id', '')
+        file_name = obj_get('name', '')
+        log.debug("Audio media type detected: %s", file_url)
         return {'url': file_url, 'name': file_name, 'type': 'audio'}
 
     # Check for file share in message_parameters (parsed from JSON content)
     if message_parameters:
-        print(f"[DEBUG] Checking message_parameters: {message_parameters}")
+        log.debug("Checking message_parameters: %s", message_parameters)
 
         # Direct check for 'file' key (Talk voice recordings format)
         if isinstance(message_parameters, dict) and 'file' in message_parameters:
             file_data = message_parameters['file']
-            print(f"[DEBUG] Found 'file' parameter: {file_data}")
+            log.debug("Found 'file' parameter: %s", file_data)
             if isinstance(file_data, dict):
                 file_name = file_data.get('name', '')
                 file_path = file_data.get('path', '')
@@ -1182,7 +1812,7 @@ def extract_file_info(message_data, message_parameters=None):
                 mimetype = file_data.get('mimetype', '')
                 file_id = file_data.get('id', '')
 
-                print(f"[DEBUG] File data: name={file_name}, path={file_path}, link={file_link}, mimetype={mimetype}")
+                log.debug("File data: name=%s, path=%s, link=%s, mimetype=%s", file_name, file_path, file_link, mimetype)
 
                 # Check if it's an audio file
                 is_audio = (
@@ -1196,22 +1826,25 @@ def extract_file_info(message_data, message_parameters=None):
 
                     # Talk recordings are stored in /Talk/ folder
                     # URL encode the filename for WebDAV
-                    encoded_name = urllib.parse.quote(file_name)
+                    encoded_name = _quote_name(file_name)
 
                     # Use WebDAV URL with Talk folder path
-                    file_url = f"{NEXTCLOUD_URL}/remote.php/dav/files/{file_owner}/Talk/{encoded_name}"
-                    print(f"[DEBUG] Audio from file parameter: {file_url}")
+                    file_url = f"{DAV_FILES}{file_owner}/Talk/{encoded_name}"
+                    log.debug("Audio from file parameter: %s", file_url)
                     return {'url': file_url, 'name': file_name, 'type': 'audio', 'mimetype': mimetype, 'link': file_link, 'id': file_id, 'owner': file_owner}
 
         # message_parameters can be a dict or list - iterate through other params
-        params_to_check = message_parameters
-        if isinstance(message_parameters, list):
-            params_to_check = {str(i): v for i, v in enumerate(message_parameters)}
+        if isinstance(message_parameters, dict):
+            params_to_check = message_parameters.items()
+        elif isinstance(message_parameters, list):
+            params_to_check = enumerate(message_parameters)
+        else:
+            params_to_check = ()
 
-        for key, value in (params_to_check.items() if isinstance(params_to_check, dict) else []):
+        for key, value in params_to_check:
             if key == 'file' or key == 'actor':
                 continue  # Already handled above
-            print(f"[DEBUG] Checking param {key}: {value}")
+            log.debug("Checking param %s: %s", key, value)
             if isinstance(value, dict):
                 param_type = value.get('type', '')
                 file_name = value.get('name', '')
@@ -1219,7 +1852,7 @@ def extract_file_info(message_data, message_parameters=None):
                 file_link = value.get('link', '')
                 mimetype = value.get('mimetype', '')
 
-                print(f"[DEBUG] Param type={param_type}, name={file_name}, mimetype={mimetype}")
+                log.debug("Param type=%s, name=%s, mimetype=%s", param_type, file_name, mimetype)
 
                 # Check if it's an audio file
                 is_audio = (
@@ -1231,51 +1864,51 @@ def extract_file_info(message_data, message_parameters=None):
                 if is_audio and (file_path or file_link or file_name):
                     # Construct WebDAV URL
                     if file_path:
-                        file_url = f"{NEXTCLOUD_URL}/remote.php/dav/files/{NEXTCLOUD_USER}/{file_path}"
+                        file_url = f"{DAV_FILES}{NEXTCLOUD_USER}/{file_path}"
                     elif file_link:
                         file_url = f"{file_link}/download"
                     else:
-                        file_url = f"{NEXTCLOUD_URL}/remote.php/dav/files/{NEXTCLOUD_USER}/{file_name}"
-                    print(f"[DEBUG] Audio from parameters: {file_url}")
+                        file_url = f"{DAV_FILES}{NEXTCLOUD_USER}/{file_name}"
+                    log.debug("Audio from parameters: %s", file_url)
                     return {'url': file_url, 'name': file_name, 'type': 'audio', 'mimetype': mimetype}
 
     # Check for file mention in content
-    content = obj.get('content', '')
-    print(f"[DEBUG] Content: {content[:200] if content else 'empty'}")
+    content = obj_get('content', '')
+    log.debug("Content: %s", content[:200] if content else 'empty')
 
     # Look for file patterns in the message
     # Pattern: {file:XXX|name:filename.mp3}
-    file_match = re.search(r'\{file:(\d+)\|name:([^}]+)\}', content)
+    file_match = _FILE_PATTERN_RE.search(content) if '{file:' in content else None
     if file_match:
         file_id = file_match.group(1)
         file_name = file_match.group(2)
-        print(f"[DEBUG] File pattern found: id={file_id}, name={file_name}")
+        log.debug("File pattern found: id=%s, name=%s", file_id, file_name)
         if is_audio_file(file_name):
             # Construct the download URL for the file
-            file_url = f"{NEXTCLOUD_URL}/remote.php/dav/files/{NEXTCLOUD_USER}/{file_name}"
-            print(f"[DEBUG] Audio file from pattern: {file_url}")
+            file_url = f"{DAV_FILES}{NEXTCLOUD_USER}/{file_name}"
+            log.debug("Audio file from pattern: %s", file_url)
             return {'url': file_url, 'name': file_name, 'type': 'audio', 'id': file_id}
 
     # Check for file share parameters in object (fallback)
-    parameters = obj.get('parameters', {})
+    parameters = obj_get('parameters', {})
     if parameters:
-        print(f"[DEBUG] Object parameters: {parameters}")
+        log.debug("Object parameters: %s", parameters)
         for key, value in parameters.items() if isinstance(parameters, dict) else []:
             if isinstance(value, dict):
                 if value.get('type') == 'file':
                     file_name = value.get('name', '')
                     file_path = value.get('path', '')
                     file_link = value.get('link', '')
-                    print(f"[DEBUG] File share found: {file_name}, path={file_path}, link={file_link}")
+                    log.debug("File share found: %s, path=%s, link=%s", file_name, file_path, file_link)
                     if is_audio_file(file_name):
                         # Construct WebDAV URL
                         if file_path:
-                            file_url = f"{NEXTCLOUD_URL}/remote.php/dav/files/{NEXTCLOUD_USER}{file_path}"
+                            file_url = f"{DAV_FILES}{NEXTCLOUD_USER}{file_path}"
                         elif file_link:
                             file_url = file_link
                         else:
-                            file_url = f"{NEXTCLOUD_URL}/remote.php/dav/files/{NEXTCLOUD_USER}/{file_name}"
-                        print(f"[DEBUG] Audio from file share: {file_url}")
+                            file_url = f"{DAV_FILES}{NEXTCLOUD_USER}/{file_name}"
+                        log.debug("Audio from file share: %s", file_url)
                         return {'url': file_url, 'name': file_name, 'type': 'audio'}
 
     return None
@@ -1283,106 +1916,321 @@ def extract_file_info(message_data, message_parameters=None):
 
 # ============== History Functions ==============
 
+_history_db_local = threading.local()
+
+# Writes are collected and flushed by a background thread instead of on every message
+STATE_FLUSH_DELAY = 2.0  # seconds
+WAL_CHECKPOINT_INTERVAL = 3600  # seconds between truncating checkpoints of the history WAL
+_pending_history_writes = []  # (sql, params) statements for messages and key facts not yet committed
+_pending_writes_lock = threading.Lock()
+_flush_lock = threading.Lock()  # one flush at a time, so batches commit in the order they were queued
+_state_dirty = threading.Event()
+_state_writer_thread = None
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    token TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    name TEXT,
+    content TEXT,
+    ts REAL,
+    intent TEXT,
+    PRIMARY KEY (token, position)
+);
+CREATE TABLE IF NOT EXISTS key_facts (
+    token TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    fact TEXT NOT NULL,
+    PRIMARY KEY (token, position)
+);
+CREATE TABLE IF NOT EXISTS pending_messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user TEXT NOT NULL,
+    token TEXT NOT NULL,
+    actor_name TEXT,
+    content TEXT NOT NULL,
+    reply_to INTEGER,
+    data TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+_SQL_INSERT_MESSAGE = 'INSERT OR REPLACE INTO messages (token, position, role, name, content, ts, intent) VALUES (?, ?, ?, ?, ?, ?, ?)'
+_SQL_TRIM_MESSAGES = 'DELETE FROM messages WHERE token = ? AND position < ?'
+_SQL_CLEAR_MESSAGES = 'DELETE FROM messages WHERE token = ?'
+_SQL_INSERT_FACT = 'INSERT INTO key_facts (token, position, fact) VALUES (?, ?, ?)'
+_SQL_CLEAR_FACTS = 'DELETE FROM key_facts WHERE token = ?'
+_SQL_START_PENDING = 'UPDATE pending_messages SET attempts = attempts + 1 WHERE id = ?'
+_SQL_DELETE_PENDING = 'DELETE FROM pending_messages WHERE id = ?'
+
+
+def _get_history_conn():
+    """Get this thread's connection to the conversation history database"""
+    conn = getattr(_history_db_local, 'conn', None)
+    if conn is None:
+        conn = sqlite3.connect(HISTORY_DB_FILE, check_same_thread=False, isolation_level=None,
+                               cached_statements=256)
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+        _history_db_local.conn = conn
+    return conn
+
+
+def _write_history(*statements):
+    """Queue (sql, params) statements for the history database; the state writer commits them"""
+    with _pending_writes_lock:
+        _pending_history_writes.extend(statements)
+    _state_dirty.set()
+
+
+def _flush_history_writes():
+    """Run all queued history statements in one transaction"""
+    with _flush_lock:
+        with _pending_writes_lock:
+            statements = _pending_history_writes[:]
+            del _pending_history_writes[:]
+        if not statements:
+            return
+        try:
+            conn = _get_history_conn()
+            conn.execute('BEGIN')
+            try:
+                for sql, params in statements:
+                    conn.execute(sql, params)
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        except Exception as e:
+            print(f"Error saving history: {e}")
+
+
+def _checkpoint_history_db():
+    """Fold the write-ahead log back into the history database and truncate it"""
+    try:
+        _get_history_conn().execute('PRAGMA wal_checkpoint(TRUNCATE)')
+    except Exception as e:
+        print(f"Error checkpointing history database: {e}")
+
+
+def _state_writer():
+    """Commit queued history and key fact writes, at most once per STATE_FLUSH_DELAY"""
+    last_checkpoint = time.monotonic()
+    while True:
+        _state_dirty.wait()
+        time.sleep(STATE_FLUSH_DELAY)
+        _state_dirty.clear()
+        _flush_history_writes()
+
+        # Appends go to the WAL; compact it now and then so it doesn't keep growing
+        if time.monotonic() - last_checkpoint >= WAL_CHECKPOINT_INTERVAL:
+            _checkpoint_history_db()
+            last_checkpoint = time.monotonic()
+
+
+def _start_state_writer():
+    global _state_writer_thread
+    with _pending_writes_lock:
+        if _state_writer_thread is None or not _state_writer_thread.is_alive():
+            _state_writer_thread = threading.Thread(target=_state_writer, daemon=True)
+            _state_writer_thread.start()
+
+
+def _migrate_history_schema(conn):
+    """Add columns that databases created by older versions don't have yet"""
+    columns = {row[1] for row in conn.execute('PRAGMA table_info(messages)')}
+    if 'intent' not in columns:
+        conn.execute('ALTER TABLE messages ADD COLUMN intent TEXT')
+
+
+def _import_legacy_history(conn):
+    """One-time import of the old conversation_history.json into the history database"""
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= 1:
+        return
+
+    rows = []
+    if os.path.exists(HISTORY_FILE):
+        with open(HISTORY_FILE, 'rb') as f:
+            legacy = _loads(f.read())
+        for token, messages in legacy.items():
+            for position, msg in enumerate(messages):
+                try:
+                    ts = datetime.fromisoformat(msg.get('timestamp', '')).timestamp()
+                except ValueError:
+                    ts = None
+                rows.append((token, position, msg['role'], msg.get('name'), msg.get('content'), ts, None))
+
+    conn.execute('BEGIN')
+    conn.executemany(_SQL_INSERT_MESSAGE, rows)
+    conn.execute('PRAGMA user_version = 1')
+    conn.execute('COMMIT')
+    if rows:
+        print(f"Imported {len(rows)} messages from {HISTORY_FILE}")
+
+
+def _import_legacy_key_facts(conn):
+    """One-time import of the old key_facts.json into the history database"""
+    if conn.execute('PRAGMA user_version').fetchone()[0] >= 2:
+        return
+
+    rows = []
+    if os.path.exists(KEY_FACTS_FILE):
+        with open(KEY_FACTS_FILE, 'rb') as f:
+            legacy = _loads(f.read())
+        for token, facts in legacy.items():
+            rows.extend((token, position, fact) for position, fact in enumerate(facts))
+
+    conn.execute('BEGIN')
+    conn.executemany(_SQL_INSERT_FACT, rows)
+    conn.execute('PRAGMA user_version = 2')
+    conn.execute('COMMIT')
+    if rows:
+        print(f"Imported {len(rows)} key facts from {KEY_FACTS_FILE}")
+
+
 def load_history():
-    """Load conversation history from file"""
-    global conversation_history, key_facts
+    """Load conversation history from the history database"""
+    global conversation_history, key_facts, _total_messages
     try:
-        if os.path.exists(HISTORY_FILE):
-            with open(HISTORY_FILE, 'r') as f:
-                conversation_history = json.load(f)
-            print(f"Loaded history for {len(conversation_history)} conversations")
+        conn = _get_history_conn()
+        conn.executescript(HISTORY_SCHEMA)
+        _migrate_history_schema(conn)
+        _import_legacy_history(conn)
+        _import_legacy_key_facts(conn)
+
+        history = {}
+        positions = {}
+        for token, position, role, name, content, ts, intent in conn.execute(
+                'SELECT token, position, role, name, content, ts, intent FROM messages ORDER BY token, position'):
+            dt = datetime.fromtimestamp(ts) if ts is not None else None
+            messages = history.get(token)
+            if messages is None:
+                messages = history[token] = deque(maxlen=MAX_HISTORY_MESSAGES * 2)
+            messages.append({
+                'role': role,
+                'name': name,
+                'content': content,
+                'timestamp': dt.isoformat() if dt else '',
+                'time_str': dt.strftime(HISTORY_TIME_FORMAT) if dt else '',
+                'intent': intent
+            })
+            positions[token] = position + 1
+
+        conversation_history = history
+        with _total_messages_lock:
+            _total_messages = sum(len(messages) for messages in history.values())
+        _history_positions.clear()
+        _history_positions.update(positions)
+        print(f"Loaded history for {len(conversation_history)} conversations")
     except Exception as e:
         print(f"Error loading history: {e}")
         conversation_history = {}
 
     # Load key facts
     try:
-        if os.path.exists(KEY_FACTS_FILE):
-            with open(KEY_FACTS_FILE, 'r') as f:
-                key_facts = json.load(f)
-            print(f"Loaded key facts for {len(key_facts)} conversations")
+        facts = {}
+        for token, fact in _get_history_conn().execute(
+                'SELECT token, fact FROM key_facts ORDER BY token, position'):
+            token_facts = facts.get(token)
+            if token_facts is None:
+                token_facts = facts[token] = deque(maxlen=MAX_KEY_FACTS)
+            token_facts.append(fact)
+        key_facts = facts
+        print(f"Loaded key facts for {len(key_facts)} conversations")
     except Exception as e:
         print(f"Error loading key facts: {e}")
         key_facts = {}
 
-
-def save_history():
-    """Save conversation history to file"""
-    try:
-        with open(HISTORY_FILE, 'w') as f:
-            json.dump(conversation_history, f, indent=2, ensure_ascii=False)
-    except Exception as e:
-        print(f"Error saving history: {e}")
+    _start_state_writer()
 
 
-def save_key_facts():
-    """Save key facts to file"""
-    global key_facts
-    try:
-        print(f"[DEBUG] Saving key facts: {key_facts}")
-        with open(KEY_FACTS_FILE, 'w') as f:
-            json.dump(key_facts, f, indent=2, ensure_ascii=False)
-        print(f"[DEBUG] Key facts saved to {KEY_FACTS_FILE}")
-    except Exception as e:
-        print(f"Error saving key facts: {e}")
-        import traceback
-        traceback.print_exc()
+def save_key_facts(token):
+    """Queue a rewrite of the stored key facts of one conversation (call with its facts write lock held)"""
+    facts = key_facts.get(token, [])
+    _write_history(
+        (_SQL_CLEAR_FACTS, (token,)),
+        *((_SQL_INSERT_FACT, (token, position, fact)) for position, fact in enumerate(facts))
+    )
 
 
 def add_key_fact(token, fact):
     """Add a key fact to remember for this conversation"""
     global key_facts
-    with facts_lock:
+    with _lock_for(_facts_locks, token, RWLock).write():
         if token not in key_facts:
-            key_facts[token] = []
+            key_facts[token] = deque(maxlen=MAX_KEY_FACTS)  # Keeps the last MAX_KEY_FACTS facts
 
         # Avoid duplicates
         if fact not in key_facts[token]:
             key_facts[token].append(fact)
-            # Keep max 20 facts per conversation
-            if len(key_facts[token]) > 20:
-                key_facts[token] = key_facts[token][-20:]
-            save_key_facts()
-            print(f"[DEBUG] Saved key fact for {token}: {fact}")
+            save_key_facts(token)
+            log.debug("Saved key fact for %s: %s", token, fact)
             return True
     return False
 
 
 def get_key_facts(token):
     """Get key facts for a conversation"""
-    with facts_lock:
-        return key_facts.get(token, [])
+    with _lock_for(_facts_locks, token, RWLock).read():
+        return list(key_facts.get(token, []))
 
 
-def add_to_history(token, role, name, content):
-    """Add a message to conversation history"""
-    with history_lock:
+def add_to_history(token, role, name, content, intent=None):
+    """Add a message to conversation history, optionally tagged with an INTENT_* marker"""
+    global _total_messages
+    with _lock_for(_history_locks, token, RWLock).write():
         if token not in conversation_history:
-            conversation_history[token] = []
+            # Bounded, so old messages drop off as new ones are appended
+            conversation_history[token] = deque(maxlen=MAX_HISTORY_MESSAGES * 2)
+
+        messages = conversation_history[token]
+        if len(messages) < messages.maxlen:
+            with _total_messages_lock:
+                _total_messages += 1
 
-        conversation_history[token].append({
+        now = datetime.now()
+        messages.append({
             'role': role,
             'name': name,
             'content': content,
-            'timestamp': datetime.now().isoformat()
+            'timestamp': now.isoformat(),
+            'time_str': now.strftime(HISTORY_TIME_FORMAT),
+            'intent': intent
         })
 
-        if len(conversation_history[token]) > MAX_HISTORY_MESSAGES * 2:
-            conversation_history[token] = conversation_history[token][-(MAX_HISTORY_MESSAGES * 2):]
+        # Append one row and drop the rows that fell out of the window
+        position = _history_positions.get(token, 0)
+        _history_positions[token] = position + 1
+        _write_history(
+            (_SQL_INSERT_MESSAGE, (token, position, role, name, content, now.timestamp(), intent)),
+            (_SQL_TRIM_MESSAGES, (token, position + 1 - MAX_HISTORY_MESSAGES * 2))
+        )
+
 
-        save_history()
+def clear_history(token):
+    """Forget the conversation history of a chat"""
+    global _total_messages
+    with _lock_for(_history_locks, token, RWLock).write():
+        removed = conversation_history.pop(token, None)
+        if removed:
+            with _total_messages_lock:
+                _total_messages -= len(removed)
+        _history_positions.pop(token, None)
+        _write_history((_SQL_CLEAR_MESSAGES, (token,)))
 
 
 def parse_message_content(content):
     """Parse message content, extracting text from JSON if needed"""
     if not content:
         return ""
-    try:
-        parsed = json.loads(content)
-        if isinstance(parsed, dict) and 'message' in parsed:
-            return parsed['message']
-    except (json.JSONDecodeError, TypeError):
-        pass
+    if content.startswith('{'):
+        try:
+            parsed = _loads(content)
+            if isinstance(parsed, dict) and 'message' in parsed:
+                return parsed['message']
+        except ValueError:
+            pass
     return content
 
 
@@ -1409,7 +2257,7 @@ def get_history_context(token):
         lines.append("")
 
     # Then add conversation history
-    with history_lock:
+    with _lock_for(_history_locks, token, RWLock).read():
         if token not in conversation_history:
             if lines:
                 lines.append("=== Nieuw gesprek ===")
@@ -1426,7 +2274,7 @@ def get_history_context(token):
         lines.append("=== GESPREKSGESCHIEDENIS ===")
 
         # Show last N messages (prioritize recent)
-        recent_messages = messages[-MAX_HISTORY_MESSAGES:]
+        recent_messages = islice(messages, max(0, len(messages) - MAX_HISTORY_MESSAGES), None)
 
         for msg in recent_messages:
             # Parse JSON content if needed
@@ -1434,23 +2282,12 @@ def get_history_context(token):
             # Truncate long messages
             content = truncate_message(content, MAX_MESSAGE_LENGTH_IN_HISTORY)
 
-            timestamp = msg.get('timestamp', '')
-            if timestamp:
-                # Extract just date and time
-                try:
-                    dt = datetime.fromisoformat(timestamp)
-                    time_str = dt.strftime("%d/%m %H:%M")
-                except:
-                    time_str = ""
-            else:
-                time_str = ""
-
-            if msg['role'] == 'user':
-                prefix = f"[{time_str}] {msg['name']}" if time_str else msg['name']
-                lines.append(f"**{prefix}:** {content}")
+            time_str = msg['time_str']
+            name = msg['name'] if msg['role'] == 'user' else "Claude"
+            if time_str:
+                lines.append(f"**[{time_str}] {name}:** {content}")
             else:
-                prefix = f"[{time_str}] Claude" if time_str else "Claude"
-                lines.append(f"**{prefix}:** {content}")
+                lines.append(f"**{name}:** {content}")
 
         lines.append("")
         lines.append("=== NIEUW BERICHT ===")
@@ -1460,33 +2297,30 @@ def get_history_context(token):
 
 # ============== Nextcloud & Claude Functions ==============
 
-def verify_signature(secret, random_header, body, signature):
-    """Verify the HMAC-SHA256 signature from Nextcloud"""
-    if not secret:
+def verify_signature(hmac_template, random_header, body, signature):
+    """Verify the HMAC-SHA256 signature from Nextcloud (keyed HMAC template, raw body as bytes)"""
+    if hmac_template is None:
         return False
-    expected = hmac.new(
-        secret.encode(),
-        (random_header + body).encode(),
-        hashlib.sha256
-    ).hexdigest()
+    mac = hmac_template.copy()
+    mac.update(random_header.encode())
+    mac.update(body)
+    expected = mac.hexdigest()
     return hmac.compare_digest(expected.lower(), signature.lower())
 
 
-def send_message(secret, token, message, reply_to=None):
-    """Send a message back to Nextcloud Talk"""
-    url = f"{NEXTCLOUD_URL}/ocs/v2.php/apps/spreed/api/v1/bot/{token}/message"
+def send_message(bot_config, token, message, reply_to=None):
+    """Send a message back to Nextcloud Talk as the bot of bot_config"""
+    url = f"{TALK_BOT_API}/{token}/message"
 
     random_str = os.urandom(32).hex()
     data = {"message": message}
     if reply_to:
         data["replyTo"] = reply_to
-    body = json.dumps(data)
+    body = _dumps_bytes(data)
 
-    signature = hmac.new(
-        secret.encode(),
-        (random_str + message).encode(),
-        hashlib.sha256
-    ).hexdigest()
+    mac = bot_config['_hmac_template'].copy()
+    mac.update((random_str + message).encode())
+    signature = mac.hexdigest()
 
     headers = {
         'Content-Type': 'application/json',
@@ -1496,7 +2330,7 @@ def send_message(secret, token, message, reply_to=None):
     }
 
     try:
-        resp = requests.post(url, headers=headers, data=body, timeout=30)
+        resp = SESSION.post(url, headers=headers, data=body, timeout=30)
         print(f"Send message response: {resp.status_code}")
         return resp.status_code == 201
     except Exception as e:
@@ -1504,18 +2338,11 @@ def send_message(secret, token, message, reply_to=None):
         return False
 
 
-def call_claude(prompt, working_dir, config_dir, bot_user, erpnext_user, task_context=None):
-    """Call Claude CLI with user-specific configuration"""
-    try:
-        env = os.environ.copy()
-        env['HOME'] = config_dir  # Use user-specific config directory
-
-        # Check if this is a task-specific conversation
-        if task_context:
-            system_context = f"""Je bent een taak-specifieke AI assistent voor Impertio.
+# System prompts for call_claude, filled in per bot user (and task) with string.Template
+SYSTEM_TASK_TEMPLATE = Template("""Je bent een taak-specifieke AI assistent voor Impertio.
 
-**HUIDIGE TAAK:** {task_context['card_title']}
-{f"**Beschrijving:** {task_context.get('card_description', '')}" if task_context.get('card_description') else ""}
+**HUIDIGE TAAK:** ${card_title}
+${card_description}
 
 Je focus is volledig op het voltooien van deze specifieke taak.
 Wees proactief: stel vragen als je meer informatie nodig hebt.
@@ -1543,7 +2370,7 @@ Wanneer de taak voltooid is, kan de gebruiker dit doen door:
 Als je denkt dat de taak klaar is, vraag dan proactief of de gebruiker de taak wil afronden.
 Na het afronden wordt de kaart verplaatst naar "Klaar" en deze chat wordt gesloten.
 
-Je werkt namens {bot_user} (ERPNext account: {erpnext_user}).
+Je werkt namens ${bot_user} (ERPNext account: ${erpnext_user}).
 
 Beschikbare MCP tools:
 - erpnext: Voor klanten, offertes, facturen, items, projecten
@@ -1554,12 +2381,11 @@ BELANGRIJK: Gebruik de MCP tools proactief! Als de gebruiker iets vraagt wat je
 
 Antwoord altijd in het Nederlands, tenzij anders gevraagd.
 
-"""
-        else:
-            # Add context about which user is making the request
-            system_context = f"""Je bent een behulpzame AI assistent voor Impertio.
-Je werkt namens {bot_user} (ERPNext account: {erpnext_user}).
-Alle ERPNext acties worden uitgevoerd met de credentials van {erpnext_user}.
+""")
+
+SYSTEM_DEFAULT_TEMPLATE = Template("""Je bent een behulpzame AI assistent voor Impertio.
+Je werkt namens ${bot_user} (ERPNext account: ${erpnext_user}).
+Alle ERPNext acties worden uitgevoerd met de credentials van ${erpnext_user}.
 
 **GEHEUGEN:**
 Als de gebruiker iets belangrijks deelt dat je moet onthouden (namen, voorkeuren, projectdetails, etc.),
@@ -1588,29 +2414,194 @@ Je kunt ook lokale bestanden uploaden en delen:
 Voorbeeld: /upload /home/maarten/rapport.pdf
 
 Beschikbare MCP tools:
-- erpnext: Voor klanten, offertes, facturen, items, etc. (draait als {erpnext_user})
+- erpnext: Voor klanten, offertes, facturen, items, etc. (draait als ${erpnext_user})
 - nextcloud: Voor bestanden, agenda, notities, delen, EN Deck taken (create_card, list_boards, get_board)
 - mailcow: Voor email beheer
 
 BELANGRIJK: Gebruik de MCP tools proactief! Als de gebruiker iets vraagt wat je kunt doen met MCP tools, doe het dan direct.
 
-"""
-        full_prompt = system_context + prompt
+""")
+
+
+# One long-running Claude CLI process per (bot user, conversation), fed over stream-json, so the
+# CLI, its config and its MCP servers start once per conversation instead of once per message.
+CLAUDE_TIMEOUT = 600  # 10 minutes
+CLAUDE_SESSION_IDLE_TIMEOUT = 1800  # seconds before an idle session process is stopped
+CLAUDE_MAX_SESSIONS = 20
+_claude_sessions = {}  # (bot user, token) -> ClaudeSession
+_claude_sessions_lock = threading.Lock()
+CLAUDE_REAP_INTERVAL = 60  # seconds between checks for idle sessions
+_claude_reaper_thread = None
 
-        cmd = [CLAUDE_PATH, '--permission-mode', 'bypassPermissions', '-p', full_prompt]
 
-        result = subprocess.run(
-            cmd,
-            capture_output=True,
+class ClaudeSession:
+    """A claude CLI process in stream-json mode that keeps one conversation"""
+
+    def __init__(self, working_dir, env):
+        self.proc = subprocess.Popen(
+            [CLAUDE_PATH, '--permission-mode', 'bypassPermissions', '-p',
+             '--input-format', 'stream-json', '--output-format', 'stream-json', '--verbose'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
             text=True,
-            timeout=600,  # 10 minutes
+            bufsize=1,
             cwd=working_dir,
             env=env
         )
+        self.events = queue.Queue()
+        self.lock = threading.Lock()  # One turn at a time
+        self.primed = False  # Whether the system context and history have been sent
+        self.last_used = time.monotonic()
+        threading.Thread(target=self._read_events, daemon=True).start()
+
+    def _read_events(self):
+        for line in self.proc.stdout:
+            self.events.put(line)
+        self.events.put(None)
+
+    def alive(self):
+        return self.proc.poll() is None
+
+    def ask(self, text, timeout):
+        """Send one user message and return (result text, is_error); raises queue.Empty on timeout"""
+        self.last_used = time.monotonic()
+        message = {'type': 'user', 'message': {'role': 'user', 'content': text}}
+        self.proc.stdin.write(_dumps(message) + '\n')
+        self.proc.stdin.flush()
+
+        deadline = time.monotonic() + timeout
+        while True:
+            line = self.events.get(timeout=max(0, deadline - time.monotonic()))
+            if line is None:
+                raise RuntimeError('Claude process exited')
+            try:
+                event = _loads(line)
+            except ValueError:
+                continue
+            if event.get('type') == 'result':
+                self.last_used = time.monotonic()
+                return event.get('result') or '', bool(event.get('is_error'))
+
+    def close(self):
+        if self.alive():
+            self.proc.kill()
+            self.proc.wait()
+
+
+def _reap_claude_sessions(room=0):
+    """Stop dead and idle sessions, and the least recently used ones so that room more fit under CLAUDE_MAX_SESSIONS (call with _claude_sessions_lock held)"""
+    now = time.monotonic()
+    by_age = sorted(_claude_sessions.items(), key=lambda item: item[1].last_used)
+    excess = len(by_age) - CLAUDE_MAX_SESSIONS + room
+    for i, (key, session) in enumerate(by_age):
+        if session.alive() and i >= excess and now - session.last_used < CLAUDE_SESSION_IDLE_TIMEOUT:
+            continue
+        if session.lock.acquire(blocking=False):  # Skip sessions that are mid-turn
+            try:
+                session.close()
+                del _claude_sessions[key]
+            finally:
+                session.lock.release()
+
+
+def _claude_reaper():
+    """Stop idle sessions every CLAUDE_REAP_INTERVAL, also when no new conversations start"""
+    while True:
+        time.sleep(CLAUDE_REAP_INTERVAL)
+        with _claude_sessions_lock:
+            _reap_claude_sessions()
+
+
+def close_claude_session(bot_user, token):
+    """Stop the Claude session of a conversation, so the next message starts with fresh context"""
+    with _claude_sessions_lock:
+        session = _claude_sessions.pop((bot_user, token), None)
+    if session:
+        session.close()
+
+
+def _ask_claude_session(session_key, working_dir, env, full_prompt, followup_prompt):
+    """
+    Send a turn to the conversation's Claude session, starting one if needed.
+
+    A new session gets full_prompt (system context plus history); a running one only followup_prompt.
+    Whoever adds history outside a Claude turn must close the session, so it restarts with that history.
+    Returns the response text, or None when the session failed and a one-shot call should be used.
+    """
+    global _claude_reaper_thread
+    with _claude_sessions_lock:
+        session = _claude_sessions.get(session_key)
+        if session is None or not session.alive():
+            _reap_claude_sessions(room=1)
+            session = ClaudeSession(working_dir, env)
+            _claude_sessions[session_key] = session
+        if _claude_reaper_thread is None or not _claude_reaper_thread.is_alive():
+            _claude_reaper_thread = threading.Thread(target=_claude_reaper, daemon=True)
+            _claude_reaper_thread.start()
+
+    with session.lock:
+        try:
+            text, is_error = session.ask(followup_prompt if session.primed else full_prompt, CLAUDE_TIMEOUT)
+            session.primed = True
+        except queue.Empty:
+            session.close()
+            return "Claude timeout - het verzoek duurde te lang (max 10 min)."
+        except Exception as e:
+            print(f"Claude session error, falling back to a single call: {e}")
+            session.close()
+            return None
+
+    return f"Error: {text}" if is_error else text
+
 
-        response = result.stdout.strip()
-        if result.returncode != 0 and result.stderr:
-            response = f"Error: {result.stderr.strip()}"
+def call_claude(prompt, working_dir, config_dir, bot_user, erpnext_user, task_context=None,
+                session_key=None, followup_prompt=None):
+    """
+    Call Claude CLI with user-specific configuration.
+
+    With session_key and followup_prompt the conversation's persistent Claude session is used:
+    prompt (with history) starts it, followup_prompt (just the new message) continues it.
+    """
+    try:
+        env = os.environ.copy()
+        env['HOME'] = config_dir  # Use user-specific config directory
+
+        # Check if this is a task-specific conversation
+        if task_context:
+            description = task_context.get('card_description')
+            system_context = SYSTEM_TASK_TEMPLATE.substitute(
+                card_title=task_context['card_title'],
+                card_description=f"**Beschrijving:** {description}" if description else "",
+                bot_user=bot_user,
+                erpnext_user=erpnext_user
+            )
+        else:
+            # Add context about which user is making the request
+            system_context = SYSTEM_DEFAULT_TEMPLATE.substitute(bot_user=bot_user, erpnext_user=erpnext_user)
+
+        full_prompt = system_context + prompt
+
+        response = None
+        if session_key is not None and followup_prompt is not None:
+            response = _ask_claude_session(session_key, working_dir, env, full_prompt, followup_prompt)
+
+        if response is None:
+            cmd = [CLAUDE_PATH, '--permission-mode', 'bypassPermissions', '-p', full_prompt]
+
+            result = subprocess.run(
+                cmd,
+                capture_output=True,
+                text=True,
+                timeout=CLAUDE_TIMEOUT,
+                cwd=working_dir,
+                env=env
+            )
+
+            response = result.stdout.strip()
+            if result.returncode != 0 and result.stderr:
+                response = f"Error: {result.stderr.strip()}"
+
+        response = response.strip()
 
         if len(response) > 30000:
             response = response[:30000] + "\n\n... (afgekapt)"
@@ -1623,34 +2614,44 @@ BELANGRIJK: Gebruik de MCP tools proactief! Als de gebruiker iets vraagt wat je
         return f"Fout: {str(e)}"
 
 
+# Webhook replies are constant, so serialize them once; Flask builds a fresh response from the bytes
+_JSON_HEADERS = {'Content-Type': 'application/json'}
+RESP_ACCEPTED = (_dumps_bytes({'status': 'accepted'}), 200, _JSON_HEADERS)
+RESP_IGNORED = (_dumps_bytes({'status': 'ignored'}), 200, _JSON_HEADERS)
+RESP_UNKNOWN_BOT = (_dumps_bytes({'error': 'Unknown bot'}), 404, _JSON_HEADERS)
+RESP_INVALID_SIGNATURE = (_dumps_bytes({'error': 'Invalid signature'}), 401, _JSON_HEADERS)
+RESP_INVALID_JSON = (_dumps_bytes({'error': 'Invalid JSON'}), 400, _JSON_HEADERS)
+
+
 def handle_webhook(user):
     """Generic webhook handler for any user"""
     bot_config = BOTS.get(user)
     if not bot_config:
-        return jsonify({'error': 'Unknown bot'}), 404
+        return RESP_UNKNOWN_BOT
 
     signature = request.headers.get('X-Nextcloud-Talk-Signature', '')
     random_header = request.headers.get('X-Nextcloud-Talk-Random', '')
-    body = request.get_data(as_text=True)
+    body = request.get_data()
 
     print(f"[{user}] Received webhook, signature present: {bool(signature)}")
 
-    if not verify_signature(bot_config['secret'], random_header, body, signature):
+    if not verify_signature(bot_config['_hmac_template'], random_header, body, signature):
         print(f"[{user}] Invalid signature!")
-        return jsonify({'error': 'Invalid signature'}), 401
+        return RESP_INVALID_SIGNATURE
 
     try:
-        data = json.loads(body)
-    except json.JSONDecodeError:
-        return jsonify({'error': 'Invalid JSON'}), 400
+        data = _loads(body)
+    except ValueError:
+        return RESP_INVALID_JSON
 
     activity_type = data.get('type')
     print(f"[{user}] Activity type: {activity_type}")
-    print(f"[{user}] Full webhook data: {json.dumps(data, indent=2, ensure_ascii=False)[:2000]}")
+    if log.isEnabledFor(logging.DEBUG):
+        log.debug("[%s] Full webhook data: %s", user, json.dumps(data, indent=2, ensure_ascii=False)[:2000])
 
     # Handle both 'Create' (normal messages) and 'Activity' (voice recordings, file shares)
     if activity_type not in ['Create', 'Activity']:
-        return jsonify({'status': 'ignored'}), 200
+        return RESP_IGNORED
 
     actor = data.get('actor', {})
     obj = data.get('object', {})
@@ -1664,133 +2665,237 @@ def handle_webhook(user):
 
     # Skip bot's own messages
     if actor.get('type') == 'Application':
-        return jsonify({'status': 'ignored'}), 200
+        return RESP_IGNORED
 
     if not message_content_raw or not token:
-        return jsonify({'status': 'ignored'}), 200
+        return RESP_IGNORED
 
-    # Parse the message content - it's usually a JSON string
-    message_content = message_content_raw
-    message_parameters = {}
+    # Acknowledge right away; the message is stored first, so a worker restart doesn't lose it
+    args = (user, bot_config, data, token, actor_name, message_content_raw, reply_to)
+    _enqueue_message(token, _store_pending_message(args), args)
+    return RESP_ACCEPTED
+
+
+def _store_pending_message(args):
+    """Store an acknowledged message until it is processed; returns its row id, or None if it couldn't be stored"""
+    user, _bot_config, data, token, actor_name, message_content_raw, reply_to = args
     try:
-        parsed_content = json.loads(message_content_raw)
-        if isinstance(parsed_content, dict):
-            message_content = parsed_content.get('message', message_content_raw)
-            message_parameters = parsed_content.get('parameters', {})
-            print(f"[{user}] Parsed message: {message_content[:100]}")
-            print(f"[{user}] Message parameters: {message_parameters}")
-    except (json.JSONDecodeError, TypeError):
-        # Not JSON, use as-is
-        pass
+        return _get_history_conn().execute(
+            'INSERT INTO pending_messages (user, token, actor_name, content, reply_to, data) VALUES (?, ?, ?, ?, ?, ?)',
+            (user, token, actor_name, message_content_raw, reply_to, _dumps(data))).lastrowid
+    except sqlite3.Error as e:
+        print(f"[{user}] Could not store message for {token}, it is lost if the worker restarts: {e}")
+        return None
 
-    print(f"[{user}] Message from {actor_name} in {token}: {message_content[:100]}")
 
-    # Check for special commands
-    if message_content.strip().lower() == '/reset':
-        with history_lock:
-            if token in conversation_history:
-                del conversation_history[token]
-                save_history()
-        success = send_message(bot_config['secret'], token, "Gespreksgeschiedenis gewist. We beginnen opnieuw!")
-        return jsonify({'status': 'ok' if success else 'failed'}), 200
-
-    if message_content.strip().lower() == '/history':
-        with history_lock:
-            count = len(conversation_history.get(token, []))
-        success = send_message(bot_config['secret'], token, f"Dit gesprek bevat {count} berichten in de geschiedenis.")
-        return jsonify({'status': 'ok' if success else 'failed'}), 200
-
-    if message_content.strip().lower() == '/whoami':
-        info = f"Bot: {user}\nERPNext user: {bot_config['erpnext_user']}\nConfig: {bot_config['config_dir']}"
-        success = send_message(bot_config['secret'], token, info)
-        return jsonify({'status': 'ok' if success else 'failed'}), 200
-
-    # Remember command - save key facts
-    if message_content.strip().lower().startswith('/remember '):
-        fact = message_content.strip()[10:].strip()
-        if not fact:
-            success = send_message(bot_config['secret'], token, "Gebruik: /remember <feit om te onthouden>")
-            return jsonify({'status': 'ok' if success else 'failed'}), 200
-
-        if add_key_fact(token, fact):
-            success = send_message(bot_config['secret'], token, f"✅ Onthouden: {fact}")
-        else:
-            success = send_message(bot_config['secret'], token, f"Dit feit was al opgeslagen.")
-        return jsonify({'status': 'ok' if success else 'failed'}), 200
-
-    # Show saved facts
-    if message_content.strip().lower() == '/facts':
-        facts = get_key_facts(token)
-        if facts:
-            facts_text = "**Opgeslagen feiten voor dit gesprek:**\n\n"
-            for i, fact in enumerate(facts, 1):
-                facts_text += f"{i}. {fact}\n"
-            facts_text += "\nGebruik /forget <nummer> om een feit te verwijderen."
-        else:
-            facts_text = "Geen opgeslagen feiten voor dit gesprek.\n\nGebruik /remember <feit> om iets te onthouden."
-        success = send_message(bot_config['secret'], token, facts_text)
-        return jsonify({'status': 'ok' if success else 'failed'}), 200
+def _mark_pending_message(row_id, sql):
+    """Run an UPDATE/DELETE on one stored message; errors only cost a retry or a duplicate after a restart"""
+    if row_id is None:
+        return
+    try:
+        _get_history_conn().execute(sql, (row_id,))
+    except sqlite3.Error as e:
+        print(f"Could not update stored message {row_id}: {e}")
 
-    # Forget a fact
-    if message_content.strip().lower().startswith('/forget '):
-        try:
-            fact_num = int(message_content.strip()[8:].strip()) - 1
-            with facts_lock:
-                if token in key_facts and 0 <= fact_num < len(key_facts[token]):
-                    removed = key_facts[token].pop(fact_num)
-                    save_key_facts()
-                    success = send_message(bot_config['secret'], token, f"✅ Vergeten: {removed}")
-                else:
-                    success = send_message(bot_config['secret'], token, "Ongeldig nummer. Gebruik /facts om de lijst te zien.")
-        except ValueError:
-            success = send_message(bot_config['secret'], token, "Gebruik: /forget <nummer>")
-        return jsonify({'status': 'ok' if success else 'failed'}), 200
-
-    # Task creation command
-    if message_content.strip().lower().startswith('/task '):
-        task_text = message_content.strip()[6:].strip()
-        if not task_text:
-            success = send_message(bot_config['secret'], token, "Gebruik: /task <taak titel>\n\nVoorbeeld: /task Offerte maken voor klant X")
-            return jsonify({'status': 'ok' if success else 'failed'}), 200
-
-        send_message(bot_config['secret'], token, f"Taak aanmaken: {task_text}...")
-
-        # Parse optional description (after |)
-        title = task_text
-        description = None
-        if '|' in task_text:
-            parts = task_text.split('|', 1)
-            title = parts[0].strip()
-            description = parts[1].strip()
-
-        result = find_or_create_task(bot_config, title, description)
-
-        if result.get('success'):
-            success = send_message(bot_config['secret'], token,
-                f"✅ **Taak aangemaakt!**\n\n**Titel:** {result['card_title']}\n**Board:** {result['board']}\n**Kolom:** {result['stack']}\n\n🔗 {result['url']}")
-        else:
-            success = send_message(bot_config['secret'], token, f"❌ Kon taak niet aanmaken: {result.get('error', 'Onbekende fout')}")
-        return jsonify({'status': 'ok' if success else 'failed'}), 200
 
-    # List boards command
-    if message_content.strip().lower() == '/boards':
-        boards = get_deck_boards(bot_config)
-        if boards:
-            boards_text = "**Jouw Deck boards:**\n\n"
-            for board in boards:
-                boards_text += f"- {board.get('title', 'Naamloos')} (ID: {board.get('id')})\n"
+def _resume_pending_messages():
+    """Queue the messages a previous worker acknowledged but didn't finish"""
+    try:
+        conn = _get_history_conn()
+        rows = conn.execute('SELECT id, user, token, actor_name, content, reply_to, data, attempts '
+                            'FROM pending_messages ORDER BY id').fetchall()
+    except sqlite3.Error as e:
+        print(f"Could not load stored messages: {e}")
+        return
+    resumed = 0
+    for row_id, user, token, actor_name, content, reply_to, data, attempts in rows:
+        bot_config = BOTS.get(user)
+        if bot_config is None or attempts >= MAX_MESSAGE_ATTEMPTS:
+            print(f"[{user}] Giving up on stored message {row_id} in {token} ({attempts} attempts)")
+            _mark_pending_message(row_id, _SQL_DELETE_PENDING)
+            continue
+        _enqueue_message(token, row_id, (user, bot_config, _loads(data), token, actor_name, content, reply_to))
+        resumed += 1
+    if resumed:
+        print(f"Resuming {resumed} message(s) left unprocessed by the previous worker")
+
+
+def _enqueue_message(token, row_id, args):
+    """Queue a message for its conversation, starting a drain task if none is running for it"""
+    with _pending_messages_lock:
+        pending = _pending_messages.get(token)
+        if pending is not None:
+            pending.append((row_id, args))
+            return
+        _pending_messages[token] = deque([(row_id, args)])
+    WEBHOOK_EXECUTOR.submit(_drain_messages, token)
+
+
+def _drain_messages(token):
+    """Process the queued messages of one conversation in arrival order until none are left"""
+    while True:
+        with _pending_messages_lock:
+            pending = _pending_messages[token]
+            if not pending:
+                del _pending_messages[token]
+                return
+            row_id, args = pending.popleft()
+        _mark_pending_message(row_id, _SQL_START_PENDING)
+        _process_message_safely(*args)
+        _mark_pending_message(row_id, _SQL_DELETE_PENDING)
+
+
+def _process_message_safely(user, bot_config, data, token, actor_name, message_content_raw, reply_to):
+    """Run _process_message, logging any error"""
+    try:
+        _process_message(user, bot_config, data, token, actor_name, message_content_raw, reply_to)
+    except Exception as e:
+        print(f"[{user}] Error processing message in {token}: {e}")
+        traceback.print_exc()
+
+
+# ============== Chat Commands ==============
+
+# Each handler gets the message context and the text after the command,
+# and returns whether the reply was sent.
+
+
+def _cmd_reset(ctx, arg):
+    """/reset - clear the conversation history"""
+    user = ctx['user']
+    bot_config = ctx['bot_config']
+    token = ctx['token']
+    clear_history(token)
+    close_claude_session(user, token)
+    success = send_message(bot_config, token, "Gespreksgeschiedenis gewist. We beginnen opnieuw!")
+    return success
+
+
+def _cmd_history(ctx, arg):
+    """/history - show the number of stored messages"""
+    bot_config = ctx['bot_config']
+    token = ctx['token']
+    with _lock_for(_history_locks, token, RWLock).read():
+        count = len(conversation_history.get(token, []))
+    success = send_message(bot_config, token, f"Dit gesprek bevat {count} berichten in de geschiedenis.")
+    return success
+
+
+def _cmd_whoami(ctx, arg):
+    """/whoami - show the bot and conversation details"""
+    user = ctx['user']
+    bot_config = ctx['bot_config']
+    token = ctx['token']
+    info = f"Bot: {user}\nERPNext user: {bot_config['erpnext_user']}\nConfig: {bot_config['config_dir']}"
+    success = send_message(bot_config, token, info)
+    return success
+
+
+def _cmd_remember(ctx, arg):
+    """/remember <feit> - save a key fact"""
+    user = ctx['user']
+    bot_config = ctx['bot_config']
+    token = ctx['token']
+    fact = arg
+    if not fact:
+        success = send_message(bot_config, token, "Gebruik: /remember <feit om te onthouden>")
+        return success
+
+    if add_key_fact(token, fact):
+        close_claude_session(user, token)  # Next message starts with the new fact in context
+        success = send_message(bot_config, token, f"✅ Onthouden: {fact}")
+    else:
+        success = send_message(bot_config, token, f"Dit feit was al opgeslagen.")
+    return success
+
+
+def _cmd_facts(ctx, arg):
+    """/facts - list the saved key facts"""
+    bot_config = ctx['bot_config']
+    token = ctx['token']
+    facts = get_key_facts(token)
+    if facts:
+        facts_text = "**Opgeslagen feiten voor dit gesprek:**\n\n"
+        for i, fact in enumerate(facts, 1):
+            facts_text += f"{i}. {fact}\n"
+        facts_text += "\nGebruik /forget <nummer> om een feit te verwijderen."
+    else:
+        facts_text = "Geen opgeslagen feiten voor dit gesprek.\n\nGebruik /remember <feit> om iets te onthouden."
+    success = send_message(bot_config, token, facts_text)
+    return success
+
+
+def _cmd_forget(ctx, arg):
+    """/forget <nummer> - remove a key fact"""
+    user = ctx['user']
+    bot_config = ctx['bot_config']
+    token = ctx['token']
+    try:
+        fact_num = int(arg) - 1
+        removed = None
+        with _lock_for(_facts_locks, token, RWLock).write():
+            if token in key_facts and 0 <= fact_num < len(key_facts[token]):
+                removed = key_facts[token][fact_num]
+                del key_facts[token][fact_num]
+                save_key_facts(token)
+        if removed is not None:
+            close_claude_session(user, token)
+            success = send_message(bot_config, token, f"✅ Vergeten: {removed}")
         else:
-            boards_text = "Geen Deck boards gevonden."
-        success = send_message(bot_config['secret'], token, boards_text)
-        return jsonify({'status': 'ok' if success else 'failed'}), 200
+            success = send_message(bot_config, token, "Ongeldig nummer. Gebruik /facts om de lijst te zien.")
+    except ValueError:
+        success = send_message(bot_config, token, "Gebruik: /forget <nummer>")
+    return success
+
+
+def _cmd_task(ctx, arg):
+    """/task <omschrijving> - create a Deck task with its own conversation"""
+    bot_config = ctx['bot_config']
+    token = ctx['token']
+    task_text = arg
+    if not task_text:
+        success = send_message(bot_config, token, "Gebruik: /task <taak titel>\n\nVoorbeeld: /task Offerte maken voor klant X")
+        return success
+
+    # Send the progress message while the card is being created
+    progress = EXECUTOR.submit(send_message, bot_config, token, f"Taak aanmaken: {task_text}...")
+
+    # Parse optional description (after |)
+    title = task_text
+    description = None
+    if '|' in task_text:
+        parts = task_text.split('|', 1)
+        title = parts[0].strip()
+        description = parts[1].strip()
+
+    result = find_or_create_task(bot_config, title, description)
+    progress.result()
+
+    if result.get('success'):
+        success = send_message(bot_config, token,
+            f"✅ **Taak aangemaakt!**\n\n**Titel:** {result['card_title']}\n**Board:** {result['board']}\n**Kolom:** {result['stack']}\n\n🔗 {result['url']}")
+    else:
+        success = send_message(bot_config, token, f"❌ Kon taak niet aanmaken: {result.get('error', 'Onbekende fout')}")
+    return success
+
+
+def _cmd_boards(ctx, arg):
+    """/boards - list the Deck boards"""
+    bot_config = ctx['bot_config']
+    token = ctx['token']
+    boards = get_deck_boards(bot_config)
+    if boards:
+        boards_text = "**Jouw Deck boards:**\n\n"
+        for board in boards:
+            boards_text += f"- {board.get('title', 'Naamloos')} (ID: {board.get('id')})\n"
+    else:
+        boards_text = "Geen Deck boards gevonden."
+    success = send_message(bot_config, token, boards_text)
+    return success
 
-    if message_content.strip().lower() == '/help':
-        # Check if this is a task conversation
-        task_bot = get_task_bot_by_token(token)
-        if task_bot:
-            help_text = f"""**Taak:** {task_bot['card_title']}
 
-**Taak afronden:**
+# /help texts; the task variant is prefixed with the card title
+HELP_TEXT_TASK = """**Taak afronden:**
 - Zeg "taak afronden", "we zijn klaar", "taak is af", etc.
 - Of typ /done
 
@@ -1805,8 +2910,8 @@ def handle_webhook(user):
 /forget <nr> - Vergeet een feit
 /reset - Wis gespreksgeschiedenis
 /help - Toon dit help bericht"""
-        else:
-            help_text = """**Commando's:**
+
+HELP_TEXT_GENERAL = """**Commando's:**
 
 **Geheugen:**
 /remember <feit> - Sla een belangrijk feit op (ik onthoud dit!)
@@ -1835,208 +2940,241 @@ def handle_webhook(user):
 /help - Dit help bericht
 
 💡 **Tip:** Gebruik /remember om belangrijke dingen te onthouden, dan vergeet ik ze niet!"""
-        success = send_message(bot_config['secret'], token, help_text)
-        return jsonify({'status': 'ok' if success else 'failed'}), 200
 
-    # Share file command
-    if message_content.strip().lower().startswith('/share '):
-        file_path = message_content.strip()[7:].strip()  # Remove '/share ' prefix
-        if not file_path:
-            success = send_message(bot_config['secret'], token, "Gebruik: /share /pad/naar/bestand.pdf")
-            return jsonify({'status': 'ok' if success else 'failed'}), 200
 
-        # Ensure path starts with /
-        if not file_path.startswith('/'):
-            file_path = '/' + file_path
+def _cmd_help(ctx, arg):
+    """/help - show the available commands"""
+    bot_config = ctx['bot_config']
+    token = ctx['token']
+    # Check if this is a task conversation
+    task_bot = ctx['task_bot']
+    if task_bot:
+        help_text = f"**Taak:** {task_bot['card_title']}\n\n{HELP_TEXT_TASK}"
+    else:
+        help_text = HELP_TEXT_GENERAL
+    success = send_message(bot_config, token, help_text)
+    return success
 
-        send_message(bot_config['secret'], token, f"Bestand delen: {file_path}...")
-        result = share_file_to_conversation(bot_config, file_path, token)
 
-        if result and result.get('success'):
-            success = send_message(bot_config['secret'], token, f"✅ Bestand gedeeld: {file_path}")
-        else:
-            success = send_message(bot_config['secret'], token, f"❌ Kon bestand niet delen: {file_path}\n\nControleer of het pad correct is en of je toegang hebt tot het bestand.")
+def _cmd_share(ctx, arg):
+    """/share <pad> - share a Nextcloud file in the conversation"""
+    bot_config = ctx['bot_config']
+    token = ctx['token']
+    file_path = arg
+    if not file_path:
+        success = send_message(bot_config, token, "Gebruik: /share /pad/naar/bestand.pdf")
+        return success
 
-        return jsonify({'status': 'ok' if success else 'failed'}), 200
+    # Ensure path starts with /
+    if not file_path.startswith('/'):
+        file_path = '/' + file_path
 
-    # Upload local file command
-    if message_content.strip().lower().startswith('/upload '):
-        local_path = message_content.strip()[8:].strip()  # Remove '/upload ' prefix
-        if not local_path:
-            success = send_message(bot_config['secret'], token, "Gebruik: /upload /pad/naar/lokaal/bestand.pdf\n\nVoorbeeld: /upload /home/maarten/OpenBooks/index.html")
-            return jsonify({'status': 'ok' if success else 'failed'}), 200
+    send_message(bot_config, token, f"Bestand delen: {file_path}...")
+    result = share_file_to_conversation(bot_config, file_path, token)
 
-        # Check if file exists
-        if not os.path.exists(local_path):
-            success = send_message(bot_config['secret'], token, f"❌ Bestand niet gevonden: {local_path}")
-            return jsonify({'status': 'ok' if success else 'failed'}), 200
+    if result and result.get('success'):
+        success = send_message(bot_config, token, f"✅ Bestand gedeeld: {file_path}")
+    else:
+        success = send_message(bot_config, token, f"❌ Kon bestand niet delen: {file_path}\n\nControleer of het pad correct is en of je toegang hebt tot het bestand.")
 
-        send_message(bot_config['secret'], token, f"Uploaden en delen: {os.path.basename(local_path)}...")
-        result = upload_and_share_file(bot_config, local_path, token)
+    return success
 
-        if result and result.get('success'):
-            if result.get('shared'):
-                success = send_message(bot_config['secret'], token, f"✅ Bestand geüpload en gedeeld: {result['filename']}\n📁 Nextcloud pad: {result['uploaded']}")
-            else:
-                success = send_message(bot_config['secret'], token, f"⚠️ Bestand geüpload maar delen mislukt: {result['filename']}\n📁 Nextcloud pad: {result['uploaded']}")
-        else:
-            success = send_message(bot_config['secret'], token, f"❌ Kon bestand niet uploaden: {local_path}\n\nFout: {result.get('error', 'Onbekende fout')}")
 
-        return jsonify({'status': 'ok' if success else 'failed'}), 200
+def _cmd_upload(ctx, arg):
+    """/upload <pad> - upload a local file and share it"""
+    bot_config = ctx['bot_config']
+    token = ctx['token']
+    local_path = arg
+    if not local_path:
+        success = send_message(bot_config, token, "Gebruik: /upload /pad/naar/lokaal/bestand.pdf\n\nVoorbeeld: /upload /home/maarten/OpenBooks/index.html")
+        return success
 
-    # Search and share file command
-    if message_content.strip().lower().startswith('/zoek '):
-        search_query = message_content.strip()[6:].strip()  # Remove '/zoek ' prefix
-        if not search_query:
-            success = send_message(bot_config['secret'], token, "Gebruik: /zoek zoekterm\n\nVoorbeeld: /zoek offerte\nVoorbeeld: /zoek rapport.pdf")
-            return jsonify({'status': 'ok' if success else 'failed'}), 200
+    # Check if file exists
+    if not os.path.exists(local_path):
+        success = send_message(bot_config, token, f"❌ Bestand niet gevonden: {local_path}")
+        return success
 
-        send_message(bot_config['secret'], token, f"🔍 Zoeken naar: {search_query}...")
+    send_message(bot_config, token, f"Uploaden en delen: {os.path.basename(local_path)}...")
+    result = upload_and_share_file(bot_config, local_path, token)
 
-        # Search for files
-        results = search_nextcloud_files(bot_config, search_query, limit=5)
+    if result and result.get('success'):
+        if result.get('shared'):
+            success = send_message(bot_config, token, f"✅ Bestand geüpload en gedeeld: {result['filename']}\n📁 Nextcloud pad: {result['uploaded']}")
+        else:
+            success = send_message(bot_config, token, f"⚠️ Bestand geüpload maar delen mislukt: {result['filename']}\n📁 Nextcloud pad: {result['uploaded']}")
+    else:
+        success = send_message(bot_config, token, f"❌ Kon bestand niet uploaden: {local_path}\n\nFout: {result.get('error', 'Onbekende fout')}")
 
-        if results:
-            # Format results
-            result_text = f"**🔍 Zoekresultaten voor '{search_query}':**\n\n"
-            for i, file in enumerate(results, 1):
-                size_kb = file['size'] / 1024 if file['size'] > 0 else 0
-                if size_kb >= 1024:
-                    size_str = f"{size_kb/1024:.1f} MB"
-                else:
-                    size_str = f"{size_kb:.0f} KB"
-                result_text += f"**{i}.** `{file['path']}`\n    📄 {file['name']} ({size_str})\n\n"
+    return success
 
-            result_text += "---\n💡 **Gebruik** `/share /pad/naar/bestand` **om een bestand te delen**"
-            success = send_message(bot_config['secret'], token, result_text)
-        else:
-            success = send_message(bot_config['secret'], token, f"❌ Geen bestanden gevonden voor: {search_query}")
 
-        return jsonify({'status': 'ok' if success else 'failed'}), 200
+def _cmd_zoek(ctx, arg):
+    """/zoek <zoekterm> - search files and list the results"""
+    bot_config = ctx['bot_config']
+    token = ctx['token']
+    search_query = arg
+    if not search_query:
+        success = send_message(bot_config, token, "Gebruik: /zoek zoekterm\n\nVoorbeeld: /zoek offerte\nVoorbeeld: /zoek rapport.pdf")
+        return success
 
-    # Quick search and share (first result)
-    if message_content.strip().lower().startswith('/vind '):
-        search_query = message_content.strip()[6:].strip()  # Remove '/vind ' prefix
-        if not search_query:
-            success = send_message(bot_config['secret'], token, "Gebruik: /vind zoekterm\n\nZoekt en deelt automatisch het eerste resultaat.\nVoorbeeld: /vind offerte-2024.pdf")
-            return jsonify({'status': 'ok' if success else 'failed'}), 200
+    send_message(bot_config, token, f"🔍 Zoeken naar: {search_query}...")
 
-        send_message(bot_config['secret'], token, f"🔍 Zoeken en delen: {search_query}...")
+    # Search for files
+    results = search_nextcloud_files(bot_config, search_query, limit=5)
 
-        # Search and share first result
-        result = search_and_share_file(bot_config, search_query, token)
+    if results:
+        # Format results
+        result_text = f"**🔍 Zoekresultaten voor '{search_query}':**\n\n"
+        for i, file in enumerate(results, 1):
+            size_kb = file['size'] / 1024 if file['size'] > 0 else 0
+            if size_kb >= 1024:
+                size_str = f"{size_kb/1024:.1f} MB"
+            else:
+                size_str = f"{size_kb:.0f} KB"
+            result_text += f"**{i}.** `{file['path']}`\n    📄 {file['name']} ({size_str})\n\n"
 
-        if result and result.get('success'):
-            success = send_message(bot_config['secret'], token, f"✅ Bestand gevonden en gedeeld:\n📄 {result.get('name', result.get('shared'))}")
-        else:
-            success = send_message(bot_config['secret'], token, f"❌ {result.get('error', 'Geen bestanden gevonden')}")
+        result_text += "---\n💡 **Gebruik** `/share /pad/naar/bestand` **om een bestand te delen**"
+        success = send_message(bot_config, token, result_text)
+    else:
+        success = send_message(bot_config, token, f"❌ Geen bestanden gevonden voor: {search_query}")
 
-        return jsonify({'status': 'ok' if success else 'failed'}), 200
+    return success
 
-    # Preview document command
-    if message_content.strip().lower().startswith('/preview '):
-        file_path = message_content.strip()[9:].strip()  # Remove '/preview ' prefix
-        if not file_path:
-            success = send_message(bot_config['secret'], token, "Gebruik: /preview /pad/naar/document\n\nOndersteunde formaten: PDF, ODT, DOCX, HTML")
-            return jsonify({'status': 'ok' if success else 'failed'}), 200
 
-        filename_lower = os.path.basename(file_path).lower()
-        is_html = filename_lower.endswith('.html') or filename_lower.endswith('.htm')
+def _cmd_vind(ctx, arg):
+    """/vind <zoekterm> - search and share the first result"""
+    bot_config = ctx['bot_config']
+    token = ctx['token']
+    search_query = arg
+    if not search_query:
+        success = send_message(bot_config, token, "Gebruik: /vind zoekterm\n\nZoekt en deelt automatisch het eerste resultaat.\nVoorbeeld: /vind offerte-2024.pdf")
+        return success
 
-        # Check if it's a Nextcloud path or local path
-        is_local = file_path.startswith('/home/') or file_path.startswith('/opt/') or file_path.startswith('/tmp/')
+    send_message(bot_config, token, f"🔍 Zoeken en delen: {search_query}...")
 
-        if is_local:
-            # Local file
-            if not os.path.exists(file_path):
-                success = send_message(bot_config['secret'], token, f"❌ Bestand niet gevonden: {file_path}")
-                return jsonify({'status': 'ok' if success else 'failed'}), 200
+    # Search and share first result
+    result = search_and_share_file(bot_config, search_query, token)
 
-            if is_html:
-                # HTML file - upload and share so Talk shows native preview
-                send_message(bot_config['secret'], token, f"📄 HTML delen: {os.path.basename(file_path)}...")
-                share_result = upload_and_share_file(bot_config, file_path, token,
-                                                     f"/Bot-Previews/{os.path.basename(file_path)}")
+    if result and result.get('success'):
+        success = send_message(bot_config, token, f"✅ Bestand gevonden en gedeeld:\n📄 {result.get('name', result.get('shared'))}")
+    else:
+        success = send_message(bot_config, token, f"❌ {result.get('error', 'Geen bestanden gevonden')}")
 
-                if share_result and share_result.get('success'):
-                    success = send_message(bot_config['secret'], token, f"📄 **Preview: {os.path.basename(file_path)}**\n\n*Klik op het bestand om te openen in Nextcloud*")
-                else:
-                    success = send_message(bot_config['secret'], token, f"❌ Kon bestand niet delen: {share_result.get('error', 'Onbekende fout')}")
-            else:
-                # PDF/ODT/DOCX - extract text
-                send_message(bot_config['secret'], token, f"📄 Preview genereren: {os.path.basename(file_path)}...")
-                result = preview_document(file_path)
-
-                if result and result.get('success'):
-                    preview_text = f"**📄 Preview: {os.path.basename(file_path)}**\n"
-                    if result.get('total_pages'):
-                        preview_text += f"*{result['total_pages']} pagina's*\n"
-                    elif result.get('paragraphs'):
-                        preview_text += f"*{result['paragraphs']} alinea's*\n"
-                    preview_text += f"\n---\n\n{result['text']}"
-                    success = send_message(bot_config['secret'], token, preview_text)
-                else:
-                    success = send_message(bot_config['secret'], token, f"❌ Kon preview niet maken: {result.get('error', 'Onbekende fout')}")
-        else:
-            # Nextcloud path - download first
-            if not file_path.startswith('/'):
-                file_path = '/' + file_path
+    return success
 
-            file_url = f"{NEXTCLOUD_URL}/remote.php/dav/files/{bot_config['nextcloud_user']}{file_path}"
 
-            if is_html:
-                # HTML - share directly from Nextcloud so Talk shows native preview
-                send_message(bot_config['secret'], token, f"📄 HTML delen: {os.path.basename(file_path)}...")
+def _cmd_preview(ctx, arg):
+    """/preview <pad> - show a text preview of a document"""
+    bot_config = ctx['bot_config']
+    token = ctx['token']
+    file_path = arg
+    if not file_path:
+        success = send_message(bot_config, token, "Gebruik: /preview /pad/naar/document\n\nOndersteunde formaten: PDF, ODT, DOCX, HTML")
+        return success
 
-                # Share the existing Nextcloud file to the conversation
-                share_result = share_file_to_conversation(bot_config, file_path, token)
+    filename_lower = os.path.basename(file_path).lower()
+    is_html = filename_lower.endswith(('.html', '.htm'))
 
-                if share_result and share_result.get('success'):
-                    success = send_message(bot_config['secret'], token, f"📄 **Preview: {os.path.basename(file_path)}**\n\n*Klik op het bestand om te openen in Nextcloud*")
-                else:
-                    success = send_message(bot_config['secret'], token, f"❌ Kon bestand niet delen: {share_result.get('error', 'Onbekende fout')}")
+    # Check if it's a Nextcloud path or local path
+    is_local = file_path.startswith(('/home/', '/opt/', '/tmp/'))
+
+    if is_local:
+        # Local file
+        if not os.path.exists(file_path):
+            success = send_message(bot_config, token, f"❌ Bestand niet gevonden: {file_path}")
+            return success
+
+        if is_html:
+            # HTML file - upload and share so Talk shows native preview
+            send_message(bot_config, token, f"📄 HTML delen: {os.path.basename(file_path)}...")
+            share_result = upload_and_share_file(bot_config, file_path, token,
+                                                 f"/Bot-Previews/{os.path.basename(file_path)}")
+
+            if share_result and share_result.get('success'):
+                success = send_message(bot_config, token, f"📄 **Preview: {os.path.basename(file_path)}**\n\n*Klik op het bestand om te openen in Nextcloud*")
             else:
-                # PDF/ODT/DOCX - extract text
-                send_message(bot_config['secret'], token, f"📄 Preview genereren: {os.path.basename(file_path)}...")
-                result = download_and_preview_document(file_url, bot_config['nextcloud_user'], bot_config['nextcloud_password'])
-
-                if result and result.get('success'):
-                    preview_text = f"**📄 Preview: {os.path.basename(file_path)}**\n"
-                    if result.get('total_pages'):
-                        preview_text += f"*{result['total_pages']} pagina's*\n"
-                    elif result.get('paragraphs'):
-                        preview_text += f"*{result['paragraphs']} alinea's*\n"
-                    preview_text += f"\n---\n\n{result['text']}"
-                    success = send_message(bot_config['secret'], token, preview_text)
-                else:
-                    success = send_message(bot_config['secret'], token, f"❌ Kon preview niet maken: {result.get('error', 'Onbekende fout')}")
+                success = send_message(bot_config, token, f"❌ Kon bestand niet delen: {share_result.get('error', 'Onbekende fout')}")
+        else:
+            # PDF/ODT/DOCX - extract text
+            send_message(bot_config, token, f"📄 Preview genereren: {os.path.basename(file_path)}...")
+            result = preview_document(file_path)
+
+            if result and result.get('success'):
+                preview_text = f"**📄 Preview: {os.path.basename(file_path)}**\n"
+                if result.get('total_pages'):
+                    preview_text += f"*{result['total_pages']} pagina's*\n"
+                elif result.get('paragraphs'):
+                    preview_text += f"*{result['paragraphs']} alinea's*\n"
+                preview_text += f"\n---\n\n{result['text']}"
+                success = send_message(bot_config, token, preview_text)
+            else:
+                success = send_message(bot_config, token, f"❌ Kon preview niet maken: {result.get('error', 'Onbekende fout')}")
+    else:
+        # Nextcloud path - download first
+        if not file_path.startswith('/'):
+            file_path = '/' + file_path
 
-        return jsonify({'status': 'ok' if success else 'failed'}), 200
+        file_url = f"{DAV_FILES}{bot_config['nextcloud_user']}{file_path}"
 
-    # Task-specific commands
-    if message_content.strip().lower() == '/done':
-        task_bot = get_task_bot_by_token(token)
-        if task_bot:
-            # Mark task as completed in database and move card
-            if complete_task(token, bot_config, task_bot):
-                send_message(bot_config['secret'], token,
-                    f"✅ **Taak afgerond!**\n\nDe taak \"{task_bot['card_title']}\" is gemarkeerd als voltooid en verplaatst naar Klaar.\n\n*Deze conversatie wordt over 3 seconden gesloten...*")
+        if is_html:
+            # HTML - share directly from Nextcloud so Talk shows native preview
+            send_message(bot_config, token, f"📄 HTML delen: {os.path.basename(file_path)}...")
+
+            # Share the existing Nextcloud file to the conversation
+            share_result = share_file_to_conversation(bot_config, file_path, token)
 
-                # Close conversation after short delay
-                import time
-                time.sleep(3)
-                close_conversation(token, bot_config['nextcloud_user'], bot_config['nextcloud_password'])
-                success = True
+            if share_result and share_result.get('success'):
+                success = send_message(bot_config, token, f"📄 **Preview: {os.path.basename(file_path)}**\n\n*Klik op het bestand om te openen in Nextcloud*")
+            else:
+                success = send_message(bot_config, token, f"❌ Kon bestand niet delen: {share_result.get('error', 'Onbekende fout')}")
+        else:
+            # PDF/ODT/DOCX - extract text
+            send_message(bot_config, token, f"📄 Preview genereren: {os.path.basename(file_path)}...")
+            result = download_and_preview_document(file_url, bot_config['nextcloud_user'], bot_config['nextcloud_password'])
+
+            if result and result.get('success'):
+                preview_text = f"**📄 Preview: {os.path.basename(file_path)}**\n"
+                if result.get('total_pages'):
+                    preview_text += f"*{result['total_pages']} pagina's*\n"
+                elif result.get('paragraphs'):
+                    preview_text += f"*{result['paragraphs']} alinea's*\n"
+                preview_text += f"\n---\n\n{result['text']}"
+                success = send_message(bot_config, token, preview_text)
             else:
-                success = send_message(bot_config['secret'], token, "Fout bij afronden van de taak.")
+                success = send_message(bot_config, token, f"❌ Kon preview niet maken: {result.get('error', 'Onbekende fout')}")
+
+    return success
+
+
+def _cmd_done(ctx, arg):
+    """/done - complete the task of this conversation"""
+    bot_config = ctx['bot_config']
+    token = ctx['token']
+    task_bot = ctx['task_bot']
+    if task_bot:
+        # Mark task as completed in database and move card
+        if complete_task(token, bot_config, task_bot):
+            send_message(bot_config, token,
+                f"✅ **Taak afgerond!**\n\nDe taak \"{task_bot['card_title']}\" is gemarkeerd als voltooid en verplaatst naar Klaar.\n\n*Deze conversatie wordt over 3 seconden gesloten...*")
+
+            # Close conversation after short delay; its Claude session isn't needed anymore
+            close_claude_session(ctx['user'], token)
+            close_conversation_later(token, bot_config)
+            success = True
         else:
-            success = send_message(bot_config['secret'], token, "Dit is geen taak-conversatie.")
-        return jsonify({'status': 'ok' if success else 'failed'}), 200
+            success = send_message(bot_config, token, "Fout bij afronden van de taak.")
+    else:
+        success = send_message(bot_config, token, "Dit is geen taak-conversatie.")
+    return success
+
 
-    if message_content.strip().lower() == '/status':
-        task_bot = get_task_bot_by_token(token)
-        if task_bot:
-            status_msg = f"""**Taak Status**
+def _cmd_status(ctx, arg):
+    """/status - show the task status of this conversation"""
+    bot_config = ctx['bot_config']
+    token = ctx['token']
+    task_bot = ctx['task_bot']
+    if task_bot:
+        status_msg = f"""**Taak Status**
 
 **Taak:** {task_bot['card_title']}
 **Status:** {task_bot['status']}
@@ -2045,76 +3183,160 @@ def handle_webhook(user):
 {f"**Afgerond:** {task_bot['completed_at']}" if task_bot.get('completed_at') else ""}
 
 Typ /done om deze taak af te ronden."""
-            success = send_message(bot_config['secret'], token, status_msg)
-        else:
-            success = send_message(bot_config['secret'], token, "Dit is geen taak-conversatie.")
-        return jsonify({'status': 'ok' if success else 'failed'}), 200
-
-    # Check for transcription request
-    if message_content.strip().lower() == '/transcribe':
-        # Check if this is a reply to an audio message or if there's a file attached
-        file_info = extract_file_info(data, message_parameters)
-
-        if file_info and file_info.get('url'):
-            send_message(bot_config['secret'], token, f"Transcriberen van {file_info.get('name', 'audio')}...")
-
-            # Download and transcribe
-            local_path = download_nextcloud_file(file_info['url'], bot_config.get('nextcloud_user'), bot_config.get('nextcloud_password'))
-            if local_path:
-                transcription = transcribe_audio(local_path)
-                if transcription:
-                    response = f"**Transcriptie:**\n\n{transcription}"
-                else:
-                    response = "Kon het audio bestand niet transcriberen. Probeer een ander formaat."
-            else:
-                response = "Kon het audio bestand niet downloaden."
+        success = send_message(bot_config, token, status_msg)
+    else:
+        success = send_message(bot_config, token, "Dit is geen taak-conversatie.")
+    return success
+
+
+def _cmd_transcribe(ctx, arg):
+    """/transcribe - transcribe the audio file replied to"""
+    bot_config = ctx['bot_config']
+    token = ctx['token']
+    reply_to = ctx['reply_to']
+    data = ctx['data']
+    message_parameters = ctx['message_parameters']
+    # Check if this is a reply to an audio message or if there's a file attached
+    file_info = extract_file_info(data, message_parameters)
+
+    if file_info and file_info.get('url'):
+        send_message(bot_config, token, f"Transcriberen van {file_info.get('name', 'audio')}...")
 
-            success = send_message(bot_config['secret'], token, response, reply_to)
-            return jsonify({'status': 'ok' if success else 'failed'}), 200
+        # Download and transcribe
+        local_path = download_nextcloud_file(file_info['url'], bot_config.get('nextcloud_user'), bot_config.get('nextcloud_password'))
+        if local_path:
+            transcription = transcribe_audio(local_path)
+            if transcription:
+                response = f"**Transcriptie:**\n\n{transcription}"
+            else:
+                response = "Kon het audio bestand niet transcriberen. Probeer een ander formaat."
         else:
-            success = send_message(bot_config['secret'], token, "Geen audio bestand gevonden. Stuur eerst een audio opname en reply dan met /transcribe")
-            return jsonify({'status': 'ok' if success else 'failed'}), 200
+            response = "Kon het audio bestand niet downloaden."
 
-    # Check for natural language completion intent in task conversations
+        success = send_message(bot_config, token, response, reply_to)
+        return success
+    else:
+        success = send_message(bot_config, token, "Geen audio bestand gevonden. Stuur eerst een audio opname en reply dan met /transcribe")
+        return success
+
+
+# Commands that are the whole message, e.g. /reset
+COMMANDS = {
+    '/reset': _cmd_reset,
+    '/history': _cmd_history,
+    '/whoami': _cmd_whoami,
+    '/facts': _cmd_facts,
+    '/boards': _cmd_boards,
+    '/help': _cmd_help,
+    '/done': _cmd_done,
+    '/status': _cmd_status,
+    '/transcribe': _cmd_transcribe,
+}
+
+# Commands followed by an argument, e.g. /task <titel>
+ARG_COMMANDS = {
+    '/remember': _cmd_remember,
+    '/forget': _cmd_forget,
+    '/task': _cmd_task,
+    '/share': _cmd_share,
+    '/upload': _cmd_upload,
+    '/zoek': _cmd_zoek,
+    '/vind': _cmd_vind,
+    '/preview': _cmd_preview,
+}
+
+# "/command" optionally followed by whitespace and an argument
+_COMMAND_RE = re.compile(r'(/\w+)(?:\s+(.*))?', re.DOTALL)
+
+# Replies that confirm a pending task completion
+CONFIRM_WORDS = frozenset({'ja', 'yes', 'ok', 'oké', 'bevestig', 'akkoord'})
+
+
+def _process_message(user, bot_config, data, token, actor_name, message_content_raw, reply_to):
+    """Handle a verified Talk message: run commands or ask Claude and send the reply. Returns whether the reply was sent"""
+    # Parse the message content - it's usually a JSON string
+    message_content = message_content_raw
+    message_parameters = {}
+    parsed_content = None
+    if message_content_raw.startswith('{'):
+        try:
+            parsed_content = _loads(message_content_raw)
+        except ValueError:
+            # Not JSON, use as-is
+            pass
+    if isinstance(parsed_content, dict):
+        message_content = parsed_content.get('message', message_content_raw)
+        message_parameters = parsed_content.get('parameters', {})
+        log.debug("[%s] Parsed message: %s", user, message_content[:100])
+        log.debug("[%s] Message parameters: %s", user, message_parameters)
+
+    print(f"[{user}] Message from {actor_name} in {token}: {message_content[:100]}")
+
+    stripped_msg = message_content.strip()
+    lower_msg = stripped_msg.lower()
+
+    # Task conversation this message belongs to, if any (looked up once per message)
     task_bot = get_task_bot_by_token(token)
+
+    # Check for special commands
+    ctx = {
+        'user': user,
+        'bot_config': bot_config,
+        'token': token,
+        'reply_to': reply_to,
+        'data': data,
+        'message_parameters': message_parameters,
+        'task_bot': task_bot,
+    }
+    match = _COMMAND_RE.fullmatch(stripped_msg)
+    if match:
+        command, arg = match.groups()
+        command = command.lower()
+        handler = COMMANDS.get(command) if arg is None else ARG_COMMANDS.get(command)
+        if handler:
+            return handler(ctx, arg or '')
+
+    # Check for natural language completion intent in task conversations
     if task_bot and task_bot.get('status') == 'active':
-        completion_intent = detect_completion_intent(message_content)
+        completion_intent = detect_completion_intent(lower_msg)
         if completion_intent == 'complete':
             # Explicit completion - complete immediately
             if complete_task(token, bot_config, task_bot):
-                send_message(bot_config['secret'], token,
+                send_message(bot_config, token,
                     f"✅ **Taak afgerond!**\n\nDe taak \"{task_bot['card_title']}\" is gemarkeerd als voltooid en verplaatst naar Klaar.\n\n*Deze conversatie wordt over 3 seconden gesloten...*")
 
-                import time
-                time.sleep(3)
-                close_conversation(token, bot_config['nextcloud_user'], bot_config['nextcloud_password'])
+                close_claude_session(user, token)
+                close_conversation_later(token, bot_config)
             else:
-                send_message(bot_config['secret'], token, "Fout bij afronden van de taak.")
-            return jsonify({'status': 'ok'}), 200
+                send_message(bot_config, token, "Fout bij afronden van de taak.")
+            return True
         elif completion_intent == 'confirm':
             # Ask for confirmation
-            send_message(bot_config['secret'], token,
+            send_message(bot_config, token,
                 f"Wil je de taak \"{task_bot['card_title']}\" afronden?\n\nTyp **ja** of **/done** om te bevestigen, of stel nog een vraag als je verder wilt werken.")
             add_to_history(token, 'user', actor_name, message_content)
-            add_to_history(token, 'assistant', 'Claude', f"Vraag om bevestiging voor afronden taak")
-            return jsonify({'status': 'ok'}), 200
+            add_to_history(token, 'assistant', 'Claude', "Vraag om bevestiging voor afronden taak",
+                           intent=INTENT_CONFIRM_COMPLETION)
+            # This exchange bypassed Claude; restart its session so the next turn is built from the history
+            close_claude_session(user, token)
+            return True
 
     # Handle confirmation response "ja" for task completion
-    if task_bot and message_content.strip().lower() in ['ja', 'yes', 'ok', 'oké', 'bevestig', 'akkoord']:
-        # Check if last message was a completion confirmation request
-        with history_lock:
+    if task_bot and lower_msg in CONFIRM_WORDS:
+        # Check if last message was a completion confirmation request (read under the lock, act outside it)
+        with _lock_for(_history_locks, token, RWLock).read():
             history = conversation_history.get(token, [])
-            if history and 'bevestiging voor afronden' in history[-1].get('content', ''):
-                if complete_task(token, bot_config, task_bot):
-                    send_message(bot_config['secret'], token,
-                        f"✅ **Taak afgerond!**\n\nDe taak \"{task_bot['card_title']}\" is gemarkeerd als voltooid en verplaatst naar Klaar.\n\n*Deze conversatie wordt over 3 seconden gesloten...*")
-
-                    import time
-                    time.sleep(3)
-                    close_conversation(token, bot_config['nextcloud_user'], bot_config['nextcloud_password'])
-                else:
-                    send_message(bot_config['secret'], token, "Fout bij afronden van de taak.")
-                return jsonify({'status': 'ok'}), 200
+            awaiting_confirm = bool(history) and history[-1].get('intent') == INTENT_CONFIRM_COMPLETION
+        if awaiting_confirm:
+            if complete_task(token, bot_config, task_bot):
+                send_message(bot_config, token,
+                    f"✅ **Taak afgerond!**\n\nDe taak \"{task_bot['card_title']}\" is gemarkeerd als voltooid en verplaatst naar Klaar.\n\n*Deze conversatie wordt over 3 seconden gesloten...*")
+
+                close_claude_session(user, token)
+                close_conversation_later(token, bot_config)
+            else:
+                send_message(bot_config, token, "Fout bij afronden van de taak.")
+            return True
 
     # Check if message contains an audio file - auto transcribe
     file_info = extract_file_info(data, message_parameters)
@@ -2122,37 +3344,33 @@ Typ /done om deze taak af te ronden."""
 
     if file_info and file_info.get('type') == 'audio' and file_info.get('url'):
         print(f"[{user}] Auto-transcribing audio: {file_info['url']}")
-        send_message(bot_config['secret'], token, f"Audio gedetecteerd ({file_info.get('name', 'audio')}). Transcriberen...")
+        send_message(bot_config, token, f"Audio gedetecteerd ({file_info.get('name', 'audio')}). Transcriberen...")
 
         local_path = download_nextcloud_file(file_info['url'], bot_config.get('nextcloud_user'), bot_config.get('nextcloud_password'))
         if local_path:
             transcription = transcribe_audio(local_path)
             if transcription:
                 # Send transcription and also process with Claude
-                send_message(bot_config['secret'], token, f"**Transcriptie:**\n{transcription}")
+                send_message(bot_config, token, f"**Transcriptie:**\n{transcription}")
                 message_content = f"[Audio transcriptie]: {transcription}"
             else:
-                send_message(bot_config['secret'], token, "Transcriptie mislukt.")
-                return jsonify({'status': 'failed'}), 200
+                send_message(bot_config, token, "Transcriptie mislukt.")
+                return False
         else:
-            send_message(bot_config['secret'], token, "Kon audio niet downloaden.")
-            return jsonify({'status': 'failed'}), 200
+            send_message(bot_config, token, "Kon audio niet downloaden.")
+            return False
 
     # Add user message to history
     add_to_history(token, 'user', actor_name, message_content)
 
     # Log user message as comment on Deck card (max 1000 chars for Deck)
     if task_bot and task_bot.get('board_id') and task_bot.get('card_id'):
-        # Account for prefix "**name:** " and "..."
-        prefix_len = len(f"**{actor_name}:** ") + 3
-        max_msg_len = 1000 - prefix_len
-        truncated_msg = message_content[:max_msg_len] + '...' if len(message_content) > max_msg_len else message_content
         add_comment_to_deck_card(
             bot_config,
             task_bot['board_id'],
             task_bot['stack_id'],
             task_bot['card_id'],
-            f"**{actor_name}:** {truncated_msg}"
+            _truncate_for_deck(f"**{actor_name}:** ", message_content)
         )
 
     # Build prompt with history context
@@ -2168,12 +3386,11 @@ Houd rekening met de context van eerdere berichten bij je antwoord.
         full_prompt = f"[{actor_name}]: {message_content}"
 
     # Check if this is a task-specific conversation
-    task_context = get_task_bot_by_token(token)
-    if task_context:
-        print(f"[{user}] Task conversation detected: {task_context['card_title']}")
-        send_message(bot_config['secret'], token, f"Bezig met taak: {task_context['card_title']}...")
+    if task_bot:
+        print(f"[{user}] Task conversation detected: {task_bot['card_title']}")
+        send_message(bot_config, token, f"Bezig met taak: {task_bot['card_title']}...")
     else:
-        send_message(bot_config['secret'], token, "Impertio AI is aan het nadenken...")
+        send_message(bot_config, token, "Impertio AI is aan het nadenken...")
 
     # Call Claude with user-specific configuration (and task context if available)
     response = call_claude(
@@ -2182,7 +3399,9 @@ Houd rekening met de context van eerdere berichten bij je antwoord.
         bot_config['config_dir'],
         user.capitalize(),
         bot_config['erpnext_user'],
-        task_context=task_context
+        task_context=task_bot,
+        session_key=(user, token),
+        followup_prompt=f"[{actor_name}]: {message_content}"
     )
     print(f"[{user}] Claude response length: {len(response)}")
 
@@ -2190,66 +3409,91 @@ Houd rekening met de context van eerdere berichten bij je antwoord.
     add_to_history(token, 'assistant', 'Claude', response)
 
     # Log Claude response as comment on Deck card
-    if task_context and task_context.get('board_id') and task_context.get('card_id'):
-        # Truncate response for comment if too long (Deck has 1000 char limit)
-        # Account for prefix "**Claude AI:** " (15 chars) + "..." (3 chars)
-        max_comment_len = 1000 - 18
-        comment_response = response[:max_comment_len] + '...' if len(response) > max_comment_len else response
+    if task_bot and task_bot.get('board_id') and task_bot.get('card_id'):
         add_comment_to_deck_card(
             bot_config,
-            task_context['board_id'],
-            task_context['stack_id'],
-            task_context['card_id'],
-            f"**Claude AI:** {comment_response}"
+            task_bot['board_id'],
+            task_bot['stack_id'],
+            task_bot['card_id'],
+            _truncate_for_deck("**Claude AI:** ", response)
         )
 
     # Send response
-    success = send_message(bot_config['secret'], token, response, reply_to)
+    success = send_message(bot_config, token, response, reply_to)
 
-    return jsonify({'status': 'ok' if success else 'failed'}), 200
+    return success
 
 
-# Routes for each user's bot
+# One route for every bot in BOTS; plain /webhook is Maarten's original bot
 @app.route('/webhook', methods=['POST'])
-def webhook_maarten():
-    """Maarten's bot (original)"""
-    return handle_webhook('maarten')
-
-
-@app.route('/webhook/albert', methods=['POST'])
-def webhook_albert():
-    """Albert's bot"""
-    return handle_webhook('albert')
-
-
-@app.route('/webhook/freek', methods=['POST'])
-def webhook_freek():
-    """Freek's bot"""
-    return handle_webhook('freek')
+@app.route('/webhook/<user>', methods=['POST'])
+def webhook(user='maarten'):
+    """Webhook of the bot named user (unknown names get a 404 from handle_webhook)"""
+    return handle_webhook(user)
 
 
 @app.route('/health', methods=['GET'])
 def health():
-    with history_lock:
-        conversation_count = len(conversation_history)
-        total_messages = sum(len(msgs) for msgs in conversation_history.values())
+    conversation_count = len(conversation_history)
+    total_messages = _total_messages
+    pending_writes = len(_pending_history_writes)
 
     return jsonify({
         'status': 'healthy',
         'bots': list(BOTS.keys()),
         'erpnext_users': {k: v['erpnext_user'] for k, v in BOTS.items()},
         'conversations': conversation_count,
-        'total_messages': total_messages
+        'total_messages': total_messages,
+        'pending_writes': pending_writes
     }), 200
 
 
-# Load history on startup
+def _is_admin_request():
+    """Whether the request carries the ADMIN_TOKEN (always False when no token is configured)"""
+    if not ADMIN_TOKEN:
+        return False
+    auth = request.headers.get('Authorization', '')
+    return hmac.compare_digest(auth.encode(), f"Bearer {ADMIN_TOKEN}".encode())
+
+
+@app.route('/refresh-deck-cache', methods=['POST'])
+def refresh_deck_cache():
+    """Drop cached Deck boards and stacks (requires ADMIN_TOKEN)"""
+    if not _is_admin_request():
+        return jsonify({'error': 'Unauthorized'}), 401
+    clear_deck_cache()
+    return jsonify({'status': 'ok'}), 200
+
+
+def shutdown():
+    """
+    Persist state before the process stops (gunicorn's worker_exit hook, see gunicorn.conf.py).
+
+    Queued messages are left to the next worker instead of drained: they stay in pending_messages, while the
+    non-daemon pool threads would otherwise run every queued Claude call first and gunicorn kills the worker
+    long before that.
+    """
+    with _pending_messages_lock:
+        kept = sum(len(pending) for pending in _pending_messages.values())
+        for pending in _pending_messages.values():
+            pending.clear()  # each drain task stops after its current message
+    if kept:
+        print(f"Shutting down: {kept} queued message(s) left for the next worker")
+    WEBHOOK_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+    _flush_history_writes()  # the state writer is a daemon thread, so commit what it hasn't yet
+    save_deck_cache()
+
+
+# Load history and Deck cache on startup
 load_history()
+load_deck_cache()
+_resume_pending_messages()
+atexit.register(shutdown)  # Covers 'python app.py'; under gunicorn worker_exit calls it first
 
 if __name__ == '__main__':
     print(f"Starting multi-user bot with Claude at {CLAUDE_PATH}")
     print(f"Configured bots: {', '.join(BOTS.keys())}")
     for name, config in BOTS.items():
         print(f"  - {name}: ERPNext={config['erpnext_user']}, Config={config['config_dir']}")
-    print(f"History file: {HISTORY_FILE}")
-    app.run(host='0.0.0.0', port=8085)
+    print(f"History database: {HISTORY_DB_FILE}")
+    app.run(host='0.0.0.0', port=8085, threaded=True)
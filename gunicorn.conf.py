@@ -0,0 +1,7 @@
+"""Gunicorn settings for the bot (loaded automatically from the working directory)"""
+
+
+def worker_exit(server, worker):
+    """Persist history and caches while the worker stops, before in-flight messages are waited on"""
+    import app
+    app.shutdown()